@@ -9,8 +9,21 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'car_reservation_app.settings')
 
 application = get_asgi_application()
+
+if settings.DEBUG:
+    # runserver serves static files itself; an ASGI server does not
+    from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
+
+    application = ASGIStaticFilesHandler(application)
+
+if settings.CARS_SEARCH_ENGINE == "memory":
+    # searches use the sql engine until the timeline is loaded
+    from cars.fleet import fleet_timeline
+
+    fleet_timeline.warm_in_background()
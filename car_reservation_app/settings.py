@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -49,6 +50,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "cars.metrics.operation_metrics_middleware",
 ]
 
 ROOT_URLCONF = "car_reservation_app.urls"
@@ -75,10 +77,66 @@ WSGI_APPLICATION = "car_reservation_app.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-DATABASES = {
+# SQLite by default. Set DATABASE_ENGINE=postgresql and the POSTGRES_*
+# variables to use PostgreSQL (docker-compose.yml does).
+#
+# Connections are closed after each request by default. Under ASGI the ORM
+# runs in sync_to_async threads, which do not reliably close persistent
+# connections (Django ticket #33497), so they would pile up until PostgreSQL
+# hits max_connections. Raise DATABASE_CONN_MAX_AGE only under WSGI, or pool
+# connections with PgBouncer instead.
+
+DATABASE_ENGINE = os.environ.get("DATABASE_ENGINE", "sqlite")
+DATABASE_CONN_MAX_AGE = int(os.environ.get("DATABASE_CONN_MAX_AGE", 0))
+
+if DATABASE_ENGINE == "postgresql":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": os.environ.get("POSTGRES_DB", "car_reservation"),
+            "USER": os.environ.get("POSTGRES_USER", "postgres"),
+            "PASSWORD": os.environ.get("POSTGRES_PASSWORD", ""),
+            "HOST": os.environ.get("POSTGRES_HOST", "localhost"),
+            "PORT": os.environ.get("POSTGRES_PORT", "5432"),
+            "CONN_MAX_AGE": DATABASE_CONN_MAX_AGE,
+            "CONN_HEALTH_CHECKS": True,
+            # server-side cursors do not survive PgBouncer transaction pooling
+            "DISABLE_SERVER_SIDE_CURSORS": os.environ.get("PGBOUNCER") == "1",
+        }
+    }
+elif DATABASE_ENGINE == "sqlite":
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": BASE_DIR / "db.sqlite3",
+            "CONN_MAX_AGE": DATABASE_CONN_MAX_AGE,
+            "CONN_HEALTH_CHECKS": True,
+        }
+    }
+else:
+    raise ValueError(f"Unsupported DATABASE_ENGINE {DATABASE_ENGINE!r}.")
+
+# PRAGMAs applied to every new SQLite connection (see cars.signals). WAL lets
+# readers run next to the single writer, and the busy timeout makes writers
+# wait for the lock instead of failing with "database is locked".
+CARS_SQLITE_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "busy_timeout": 5000,
+    "cache_size": -64000,
+    "mmap_size": 268435456,
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHES = {
     "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+        "BACKEND": os.environ.get(
+            "CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": os.environ.get("CACHE_LOCATION", ""),
     }
 }
 
@@ -126,18 +184,73 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 GRAPHENE = {"SCHEMA": "cars.schema.schema"}
 
-# LOGGING = {
-#    "version": 1,
-#    "disable_existing_loggers": False,
-#    "handlers": {
-#        "console": {
-#            "class": "logging.StreamHandler",
-#        },
-#    },
-#    "loggers": {
-#        "django.db.backends": {
-#            "handlers": ["console"],
-#            "level": "DEBUG",
-#        },
-#    },
-# }
+# Availability search engine used by cars.car_search.get_available_cars:
+# "python" checks candidates one by one, "sql" runs a single ranked query,
+# "lazy" loads one branch at a time, nearest to the pickup branch first, and
+# is the fastest to the first car but the slowest to list every car.
+# "memory" answers from cars.fleet.fleet_timeline, an in-process copy of the
+# reservations and branch logs loaded when the server starts; it falls back
+# to "sql" until loaded.
+CARS_SEARCH_ENGINE = os.environ.get("CARS_SEARCH_ENGINE", "python")
+# Seconds before the "memory" copy is reloaded to pick up the changes made by
+# other processes, which its signals do not see.
+CARS_FLEET_TIMELINE_TTL = int(os.environ.get("CARS_FLEET_TIMELINE_TTL", 60))
+
+# Opt-in in-process cache of search results (see cars.availability). Searches
+# are widened to CARS_AVAILABILITY_BUCKET-second buckets so nearby windows
+# share an entry; entries live CARS_AVAILABILITY_CACHE_TTL seconds.
+CARS_AVAILABILITY_CACHE = os.environ.get("CARS_AVAILABILITY_CACHE") == "1"
+CARS_AVAILABILITY_BUCKET = 15 * 60
+CARS_AVAILABILITY_CACHE_TTL = 30
+CARS_AVAILABILITY_CACHE_SIZE = 1024
+
+# How reserve_car guards against concurrent bookings: "lock" locks the car row
+# and repeats the availability checks, "constraint" inserts directly and relies
+# on the overlap constraint of PostgreSQL/SQLite (transfer times between
+# neighbouring reservations are then only checked by the search).
+CARS_RESERVATION_CHECK = "lock"
+
+# Largest page the allCarsConnection/upcomingReservationsConnection fields return.
+CARS_MAX_PAGE_SIZE = 100
+
+# Parsed and validated GraphQL documents kept by cars.documents.document_cache,
+# which also serves automatic persisted queries.
+CARS_DOCUMENT_CACHE_SIZE = 256
+
+# Opt-in cache of read query responses (see cars.responses), stored in the
+# CARS_RESPONSE_CACHE_ALIAS cache. Changes to cars, reservations, branch logs
+# and branches expire the affected responses; upcomingReservations also
+# expires after CARS_RESPONSE_CACHE_UPCOMING_TIMEOUT seconds since it
+# depends on the current time.
+CARS_RESPONSE_CACHE = os.environ.get("CARS_RESPONSE_CACHE") == "1"
+CARS_RESPONSE_CACHE_ALIAS = "default"
+CARS_RESPONSE_CACHE_TIMEOUT = 300
+CARS_RESPONSE_CACHE_UPCOMING_TIMEOUT = 30
+
+# Stream the allCars/upcomingReservations lists in chunks instead of loading
+# them at once; on PostgreSQL the chunks are read from a server-side cursor.
+CARS_SERVER_SIDE_CURSORS = os.environ.get("CARS_SERVER_SIDE_CURSORS") == "1"
+
+# Opt-in per-operation GraphQL metrics (see cars.metrics): wall time,
+# SQL queries and time, the slowest resolver and the search, distance and
+# insert sections, served in Prometheus format on /metrics. With
+# CARS_METRICS_LOG every operation is also logged as a JSON line.
+CARS_METRICS = os.environ.get("CARS_METRICS") == "1"
+CARS_METRICS_LOG = os.environ.get("CARS_METRICS_LOG") == "1"
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {
+        "console": {
+            "class": "logging.StreamHandler",
+        },
+    },
+    "loggers": {
+        "cars.metrics": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
+    },
+}
@@ -17,10 +17,11 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 from django.views.decorators.csrf import csrf_exempt
-from graphene_django.views import GraphQLView
 from cars.schema import schema
+from cars.views import AsyncGraphQLView, metrics
 
 urlpatterns = [
     path("admin/", admin.site.urls),
-    path("graphql", csrf_exempt(GraphQLView.as_view(graphiql=True, schema=schema))),
+    path("graphql", csrf_exempt(AsyncGraphQLView.as_view(graphiql=True, schema=schema))),
+    path("metrics", metrics),
 ]
@@ -9,8 +9,15 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/wsgi/
 
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'car_reservation_app.settings')
 
 application = get_wsgi_application()
+
+if settings.CARS_SEARCH_ENGINE == "memory":
+    # searches use the sql engine until the timeline is loaded
+    from cars.fleet import fleet_timeline
+
+    fleet_timeline.warm_in_background()
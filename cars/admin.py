@@ -1,5 +1,13 @@
 from django.contrib import admin
-from cars.models import Branch, Car, Reservation, Distance, CarBranchLog
+from cars.models import (
+    Branch,
+    Car,
+    Reservation,
+    Distance,
+    CarBranchLog,
+    CarLocation,
+    CarTransition,
+)
 
 # Register your models here.
 admin.site.register(Branch)
@@ -7,3 +15,5 @@ admin.site.register(Car)
 admin.site.register(Reservation)
 admin.site.register(Distance)
 admin.site.register(CarBranchLog)
+admin.site.register(CarLocation)
+admin.site.register(CarTransition)
@@ -0,0 +1,278 @@
+import bisect
+import time
+from collections import defaultdict, namedtuple
+
+from django.db import IntegrityError, transaction
+from cars.bulk import bulk_reserve
+from cars.conflicts import is_overlap_conflict
+from cars.instrumentation import current_operation, section
+from cars.car_search import (
+    is_car_available_lower_bound,
+    is_car_available_upper_bound,
+)
+from cars.models import Car, Distance, Reservation
+
+Booking = namedtuple(
+    "Booking",
+    ["start_time", "end_time", "pickup_branch_id", "return_branch_id", "request"],
+)
+
+
+class CarTimeline:
+    """Bookings of one car sorted by start time.
+
+    Bookings loaded from the database have no ``request``; bookings placed by
+    the planner carry the index of their reservation request.
+    """
+
+    def __init__(self, car_id, branch_id):
+        self.car_id = car_id
+        self.branch_id = branch_id
+        self.bookings = []
+        self.starts = []
+
+    def add(self, booking):
+        index = bisect.bisect(self.starts, booking.start_time)
+        self.starts.insert(index, booking.start_time)
+        self.bookings.insert(index, booking)
+
+    def remove(self, booking):
+        index = self.bookings.index(booking)
+        del self.starts[index]
+        del self.bookings[index]
+
+    def previous(self, start_time):
+        """Return the last booking ending before ``start_time``, or None.
+
+        Bookings of a car do not overlap, so it is the nearest one before
+        the bookings that start at or after ``start_time``.
+        """
+        index = bisect.bisect_left(self.starts, start_time)
+        while index:
+            index -= 1
+            if self.bookings[index].end_time < start_time:
+                return self.bookings[index]
+        return None
+
+    def branch_at(self, start_time):
+        previous = self.previous(start_time)
+        return previous.return_branch_id if previous else self.branch_id
+
+    def blockers(self, start_time, end_time, pickup_branch, return_branch):
+        """Return the bookings preventing a new one, or None if any is fixed.
+
+        An empty list means the booking fits as is.
+        """
+        blockers = []
+        index = bisect.bisect_right(self.starts, end_time)
+
+        for booking in self.bookings[:index]:
+            if booking.end_time >= start_time:
+                blockers.append(booking)
+
+        if index < len(self.bookings):
+            following = self.bookings[index]
+            if not is_car_available_upper_bound(following, end_time, return_branch):
+                blockers.append(following)
+
+        previous = self.previous(start_time)
+        if previous and not is_car_available_lower_bound(
+            previous, start_time, pickup_branch
+        ):
+            blockers.append(previous)
+
+        if any(booking.request is None for booking in blockers):
+            return None
+        return blockers
+
+
+class BatchPlanner:
+    """Assign a batch of reservation requests to cars in memory.
+
+    The fleet and every reservation that can interact with the batch window
+    are loaded once. Requests are matched to cars with augmenting paths
+    (Kuhn's algorithm): a request that finds no free car may take over a car
+    from an earlier request if that request can be moved to another car.
+    Cars are tried nearest-first by distance from their branch at the start
+    of the reservation to the pickup branch.
+    """
+
+    def __init__(self, requests):
+        record = current_operation.get()
+        started = time.perf_counter() if record else None
+
+        self.requests = requests
+        self.assignments = {}
+        # request -> timelines nearest to its pickup first, see candidates()
+        self.orders = {}
+        window_start = min(request[0] for request in requests)
+        window_end = max(request[1] for request in requests)
+
+        self.timelines = {
+            car_id: CarTimeline(car_id, branch_id)
+            for car_id, branch_id in Car.objects.with_current_branch(
+                window_start
+            ).values_list("id", "current_branch_id")
+        }
+
+        fields = (
+            "car_id",
+            "start_time",
+            "end_time",
+            "pickup_branch_id",
+            "return_branch_id",
+        )
+        reservations = Reservation.objects.filter(
+            end_time__gte=window_start, start_time__lte=window_end
+        ).values_list(*fields)
+        previous_reservations = Reservation.objects.previous_reservations(
+            window_start
+        ).values_list(*fields)
+        next_reservations = Reservation.objects.next_reservations(
+            window_end
+        ).values_list(*fields)
+
+        for query in (reservations, previous_reservations, next_reservations):
+            for car_id, *booking in query:
+                if car_id in self.timelines:
+                    self.timelines[car_id].add(Booking(*booking, None))
+
+        if record:
+            record.add_stage("planner_load", started, rows=len(self.timelines))
+
+    def candidates(self, request, visited):
+        """Yield the timelines not in ``visited``, nearest to the pickup first.
+
+        Timelines are grouped by their branch at the start of the request and
+        the groups ordered by ``DistanceTable.neighbors``, so distances are
+        looked up once per branch. Branches without a route come last. The
+        order is computed the first time a request is tried and reused on
+        every step of later augmenting paths; ``blockers`` still checks each
+        car against its current bookings.
+        """
+        order = self.orders.get(request)
+        if order is None:
+            order = self.orders[request] = self.order(request)
+        return (timeline for timeline in order if timeline.car_id not in visited)
+
+    def order(self, request):
+        start_time, _, pickup_branch, _ = self.requests[request]
+        branch_to_timelines = defaultdict(list)
+        for timeline in self.timelines.values():
+            branch_to_timelines[timeline.branch_at(start_time)].append(timeline)
+
+        timelines = []
+        for _, branch_id in Distance.objects.matrix().neighbors(pickup_branch):
+            timelines.extend(branch_to_timelines.pop(branch_id, ()))
+        for unreachable in branch_to_timelines.values():
+            timelines.extend(unreachable)
+        return timelines
+
+    def place(self, request, timeline):
+        start_time, end_time, pickup_branch, return_branch = self.requests[request]
+        booking = Booking(
+            start_time, end_time, pickup_branch.id, return_branch.id, request
+        )
+        timeline.add(booking)
+        self.assignments[request] = (timeline, booking)
+
+    def unplace(self, request):
+        timeline, booking = self.assignments.pop(request)
+        timeline.remove(booking)
+
+    def assign(self, request, visited):
+        """Find a car for ``request``, moving earlier requests along the way.
+
+        The augmenting path is searched depth-first with an explicit stack,
+        so long chains of moved requests cannot exhaust the recursion limit.
+        Each entry holds a request, its remaining candidates and the swap
+        tried on the current one: the timeline and the request moved off it.
+        """
+        stack = [[request, self.candidates(request, visited), None]]
+        while stack:
+            frame = stack[-1]
+            request, candidates, swap = frame
+            if swap is not None:
+                # the moved request found no other car, so put it back
+                timeline, moved = swap
+                self.unplace(request)
+                self.place(moved, timeline)
+                frame[2] = None
+
+            for timeline in candidates:
+                blockers = timeline.blockers(*self.requests[request])
+                if blockers is None or len(blockers) > 1:
+                    continue
+
+                visited.add(timeline.car_id)
+                if not blockers:
+                    self.place(request, timeline)
+                    return True
+
+                moved = blockers[0].request
+                self.unplace(moved)
+                if timeline.blockers(*self.requests[request]) != []:
+                    self.place(moved, timeline)
+                    continue
+
+                self.place(request, timeline)
+                frame[2] = (timeline, moved)
+                stack.append([moved, self.candidates(moved, visited), None])
+                break
+            else:
+                stack.pop()
+
+        return False
+
+    def solve(self):
+        """Return the car id for every request, or None if one cannot be served."""
+        record = current_operation.get()
+        started = time.perf_counter() if record else None
+
+        for request in range(len(self.requests)):
+            if not self.assign(request, set()):
+                if record:
+                    record.add_stage(
+                        "planner_assign", started, rows=request, unserved=1
+                    )
+                return None
+
+        if record:
+            record.add_stage("planner_assign", started, rows=len(self.requests))
+
+        return [
+            self.assignments[request][0].car_id for request in range(len(self.requests))
+        ]
+
+
+@transaction.atomic
+def reserve_cars(reservation_request_list):
+    reservation_request_list.sort(key=lambda x: x[0])
+
+    with section("search"):
+        planner = BatchPlanner(reservation_request_list)
+    with section("assign"):
+        car_ids = planner.solve()
+    if car_ids is None:
+        return []
+
+    cars = Car.objects.in_bulk(car_ids)
+    try:
+        with section("insert"):
+            return bulk_reserve(
+                Reservation(
+                    car=cars[car_id],
+                    start_time=start_time,
+                    end_time=end_time,
+                    pickup_branch=pickup_branch,
+                    return_branch=return_branch,
+                )
+                for car_id, (start_time, end_time, pickup_branch, return_branch) in zip(
+                    car_ids, reservation_request_list
+                )
+            )
+    except IntegrityError as error:
+        # a concurrent booking took one of the planned cars
+        if is_overlap_conflict(error):
+            return []
+        raise
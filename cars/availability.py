@@ -0,0 +1,138 @@
+import datetime
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from cars.distances import branch_id
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def bucket_window(start_time, end_time):
+    """Widen a reservation window to whole ``CARS_AVAILABILITY_BUCKET`` buckets.
+
+    A car available for the widened window is available for every window
+    inside it, so the cars found for the bucket are valid for all searches
+    that fall into it.
+    """
+    size = datetime.timedelta(seconds=settings.CARS_AVAILABILITY_BUCKET)
+    start_bucket = (start_time - EPOCH) // size
+    end_bucket = -((EPOCH - end_time) // size)
+    return EPOCH + start_bucket * size, EPOCH + end_bucket * size
+
+
+class AvailabilityCache:
+    """Process-wide LRU of available car ids per bucketed search window.
+
+    Entries are keyed by the bucketed window and the pickup and return
+    branches, hold the ids in search order and expire after
+    ``CARS_AVAILABILITY_CACHE_TTL`` seconds. A reverse index from car to
+    entries lets a new reservation remove just that car. A deleted or moved
+    reservation drops the entries overlapping the stretch it leaves free
+    (see ``ReservationManager.free_window``), since the car may have become
+    available there, including through transfer times.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._keys_by_car = defaultdict(set)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_rejections = 0
+
+    def key(self, start_time, end_time, pickup_branch, return_branch):
+        return (
+            *bucket_window(start_time, end_time),
+            branch_id(pickup_branch),
+            branch_id(return_branch),
+        )
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(entry[1])
+
+    def set(self, key, car_ids):
+        expires = time.monotonic() + settings.CARS_AVAILABILITY_CACHE_TTL
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (expires, list(car_ids))
+            for car_id in car_ids:
+                self._keys_by_car[car_id].add(key)
+
+            while len(self._entries) > settings.CARS_AVAILABILITY_CACHE_SIZE:
+                self._drop(next(iter(self._entries)))
+
+    def reject(self, car_ids):
+        """Count cached cars found unavailable when a hit was re-checked."""
+        with self._lock:
+            self.stale_rejections += len(car_ids)
+        self.remove_cars(car_ids)
+
+    def remove_cars(self, car_ids):
+        """Remove cars that are no longer available from every entry."""
+        with self._lock:
+            for car_id in car_ids:
+                for key in self._keys_by_car.pop(car_id, ()):
+                    entry = self._entries.get(key)
+                    if entry is not None:
+                        entry[1].remove(car_id)
+
+    def drop_overlapping(self, start_time, end_time):
+        """Drop the entries whose window overlaps ``start_time``-``end_time``.
+
+        A bound of None leaves that side of the window open.
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if (end_time is None or key[0] <= end_time) and (
+                    start_time is None or key[1] >= start_time
+                ):
+                    self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_car.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "stale_rejections": self.stale_rejections,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = self.evictions = self.stale_rejections = 0
+
+    def _drop(self, key):
+        _, car_ids = self._entries.pop(key)
+        self.evictions += 1
+        for car_id in car_ids:
+            keys = self._keys_by_car.get(car_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_car[car_id]
+
+
+availability_cache = AvailabilityCache()
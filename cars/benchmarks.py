@@ -0,0 +1,208 @@
+import datetime
+import math
+import statistics
+import threading
+import time
+import tracemalloc
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from cars.bulk import bulk_reserve, move_cars
+from cars.car_search import reserve_car
+from cars.distances import distance_cache
+from cars.models import Branch, Car, CarBranchLog, Distance, Reservation
+
+
+def timed(function, repeat):
+    """Run ``function`` ``repeat`` times and return the durations in seconds."""
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+def median_ms(durations):
+    return statistics.median(durations) * 1000
+
+
+def percentile_ms(durations, percent):
+    """Return the nearest-rank ``percent`` percentile of ``durations`` in ms."""
+    ordered = sorted(durations)
+    rank = max(math.ceil(percent / 100 * len(ordered)), 1)
+    return ordered[rank - 1] * 1000
+
+
+def measure(function, repeat):
+    """Time ``function`` and count its queries and peak memory.
+
+    Every run is timed; queries are counted on the first run and the peak
+    of traced allocations is taken from one extra run, since tracing slows
+    down the timed ones.
+    """
+    durations = []
+    queries = None
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as context:
+            started = time.perf_counter()
+            function()
+            durations.append(time.perf_counter() - started)
+        if queries is None:
+            queries = len(context.captured_queries)
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "p50_ms": round(percentile_ms(durations, 50), 3),
+        "p99_ms": round(percentile_ms(durations, 99), 3),
+        "queries": queries,
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+
+def create_branches(count):
+    return Branch.objects.bulk_create(
+        Branch(city=f"Benchmark {number}") for number in range(count)
+    )
+
+
+def create_cars(count):
+    return Car.objects.bulk_create(
+        Car(car_number=f"C{number}", make="Toyota", model="Camry")
+        for number in range(count)
+    )
+
+
+def create_distances(branches, rng, low=50, high=800):
+    """Connect every pair of ``branches`` both ways with random distances."""
+    distances = Distance.objects.bulk_create(
+        Distance(
+            from_branch=from_branch,
+            to_branch=to_branch,
+            distance_km=rng.randint(low, high),
+        )
+        for from_branch in branches
+        for to_branch in branches
+        if from_branch != to_branch
+    )
+    # bulk_create sends no post_save
+    distance_cache.clear()
+    return distances
+
+
+def place_cars(cars, branches, timestamp):
+    """Put ``cars`` round-robin at ``branches`` as of ``timestamp``."""
+    car_branch_logs = CarBranchLog.objects.bulk_create(
+        CarBranchLog(
+            car=car, branch=branches[number % len(branches)], timestamp=timestamp
+        )
+        for number, car in enumerate(cars)
+    )
+    move_cars(car_branch_logs)
+
+
+def create_upcoming(cars, branches, count, since, rng, batch_size=10000):
+    """Bulk insert ``count`` future reservations with random gaps and branches.
+
+    Each car gets a chain of reservations starting after ``since``, with
+    every reservation starting from the branch the previous one returned to.
+    """
+    next_start = {car.id: since for car in cars}
+    branch_of = {}
+    batch = []
+    for number in range(count):
+        car = cars[number % len(cars)]
+        start_time = next_start[car.id] + datetime.timedelta(
+            hours=rng.randint(1, 48)
+        )
+        end_time = start_time + datetime.timedelta(hours=rng.randint(2, 24))
+        pickup_branch = branch_of.get(car.id, branches[number % len(branches)])
+        return_branch = rng.choice(branches)
+        batch.append(
+            Reservation(
+                car=car,
+                start_time=start_time,
+                end_time=end_time,
+                pickup_branch=pickup_branch,
+                return_branch=return_branch,
+            )
+        )
+        next_start[car.id] = end_time
+        branch_of[car.id] = return_branch
+        if len(batch) == batch_size:
+            bulk_reserve(batch)
+            batch = []
+    bulk_reserve(batch)
+
+
+def create_history(cars, branches, count, until, offset=0, batch_size=10000):
+    """Bulk insert ``count`` back-to-back past reservations ending before ``until``.
+
+    Reservations are spread round-robin over ``cars`` and go back in time, so
+    calling this again with ``offset`` set to the rows created so far deepens
+    every car's history while the present stays the same.
+    """
+    slot = datetime.timedelta(hours=3)
+    duration = datetime.timedelta(hours=2)
+    batch = []
+    for number in range(offset, offset + count):
+        start_time = until - slot * (number // len(cars) + 1)
+        branch = branches[number % len(branches)]
+        batch.append(
+            Reservation(
+                car=cars[number % len(cars)],
+                start_time=start_time,
+                end_time=start_time + duration,
+                pickup_branch=branch,
+                return_branch=branch,
+            )
+        )
+        if len(batch) == batch_size:
+            bulk_reserve(batch)
+            batch = []
+    bulk_reserve(batch)
+
+
+def reserve_concurrently(requests, threads):
+    """Call ``reserve_car`` for every request from ``threads`` worker threads.
+
+    Returns the created reservations, the elapsed seconds and the errors the
+    workers raised.
+    """
+    pending = list(reversed(requests))
+    reservations = []
+    errors = []
+    lock = threading.Lock()
+
+    def work():
+        try:
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    request = pending.pop()
+                try:
+                    reservation = reserve_car(*request)
+                except Exception as error:
+                    with lock:
+                        errors.append(error)
+                    continue
+                if reservation:
+                    with lock:
+                        reservations.append(reservation)
+        finally:
+            connection.close()
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return reservations, time.perf_counter() - started, errors
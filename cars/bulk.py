@@ -0,0 +1,72 @@
+from django.db import transaction
+from cars.models import CarBranchLog, CarLocation, CarTransition, Reservation
+from cars.signals import reservations_bulk_created
+
+
+def move_cars(car_branch_logs):
+    """Point every car's ``CarLocation`` at its latest entry in ``car_branch_logs``.
+
+    The cars' ``CarTransition`` stays are rebuilt as well.
+    """
+    latest = {}
+    for log in car_branch_logs:
+        if log.car_id not in latest or log.timestamp > latest[log.car_id].timestamp:
+            latest[log.car_id] = log
+
+    locations = CarLocation.objects.in_bulk(latest.keys())
+    created = []
+    updated = []
+    for car_id, log in latest.items():
+        location = locations.get(car_id)
+        if location is None:
+            created.append(
+                CarLocation(
+                    car_id=car_id, branch_id=log.branch_id, timestamp=log.timestamp
+                )
+            )
+        elif location.timestamp <= log.timestamp:
+            location.branch_id = log.branch_id
+            location.timestamp = log.timestamp
+            updated.append(location)
+
+    CarLocation.objects.bulk_create(created)
+    CarLocation.objects.bulk_update(updated, ["branch", "timestamp"])
+    CarTransition.objects.rebuild(latest.keys())
+
+
+@transaction.atomic
+def bulk_reserve(reservations):
+    """Insert ``reservations`` as ``Reservation.save`` would, in a few statements.
+
+    The reservations, their pickup and return ``CarBranchLog`` entries and the
+    cars' ``CarLocation`` are written in one transaction, and the database
+    enforces the same unique constraints. ``bulk_create`` sends no
+    ``post_save``, so ``reservations_bulk_created`` is sent instead.
+    """
+    reservations = Reservation.objects.bulk_create(reservations)
+
+    car_branch_logs = []
+    for reservation in reservations:
+        car_branch_logs.append(
+            CarBranchLog(
+                car_id=reservation.car_id,
+                branch_id=reservation.pickup_branch_id,
+                timestamp=reservation.start_time,
+            )
+        )
+        car_branch_logs.append(
+            CarBranchLog(
+                car_id=reservation.car_id,
+                branch_id=reservation.return_branch_id,
+                timestamp=reservation.end_time,
+            )
+        )
+    CarBranchLog.objects.bulk_create(car_branch_logs)
+    move_cars(car_branch_logs)
+
+    reservations_bulk_created.send(
+        sender=Reservation,
+        reservations=reservations,
+        car_branch_logs=car_branch_logs,
+    )
+    return reservations
@@ -1,14 +1,25 @@
+import itertools
+import time
 from collections import defaultdict
-from cars.models import Car, Distance, Reservation, Branch
-from graphql import GraphQLError
-from django.db import transaction
+from cars.availability import availability_cache, bucket_window
+from cars.conflicts import has_overlap_constraint, is_overlap_conflict
+from cars.fleet import fleet_timeline
+from cars.instrumentation import current_operation, section, section_iter
+from cars.models import Branch, Car, Distance, Reservation
+from django.conf import settings
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.db.models import F, Q
+
+RESERVE_RETRIES = 10
+RESERVE_RETRY_DELAY = 0.05
+SEARCH_BATCH_SIZE = 100
 
 
 def is_car_available_lower_bound(res, start_time, pickup_branch):
-    if res.return_branch == pickup_branch and res.end_time < start_time:
+    if res.return_branch_id == pickup_branch.id and res.end_time < start_time:
         return True
     required_transfer_time = Distance.objects.transfer_time(
-        res.return_branch, pickup_branch
+        res.return_branch_id, pickup_branch
     )
     if required_transfer_time:
         if start_time - required_transfer_time >= res.end_time:
@@ -17,10 +28,10 @@ def is_car_available_lower_bound(res, start_time, pickup_branch):
 
 
 def is_car_available_upper_bound(res, end_time, return_branch):
-    if res.pickup_branch == return_branch and res.start_time > end_time:
+    if res.pickup_branch_id == return_branch.id and res.start_time > end_time:
         return True
     required_transfer_time = Distance.objects.transfer_time(
-        res.pickup_branch, return_branch
+        res.pickup_branch_id, return_branch
     )
     if required_transfer_time:
         if end_time + required_transfer_time <= res.start_time:
@@ -29,10 +40,25 @@ def is_car_available_upper_bound(res, end_time, return_branch):
 
 
 def get_available_cars(start_time, end_time, pickup_branch, return_branch):
+    engine = SEARCH_ENGINES[settings.CARS_SEARCH_ENGINE]
+    return engine(start_time, end_time, pickup_branch, return_branch)
+
+
+def get_available_cars_python(start_time, end_time, pickup_branch, return_branch):
+    record = current_operation.get()
+    started = time.perf_counter() if record else None
+
     branch_to_cars = defaultdict(list)
-    available_cars = Car.objects.available_cars(
-        start_time, end_time
-    ).with_current_branch(start_time)
+    available_cars = (
+        Car.objects.available_cars(start_time, end_time)
+        .with_current_branch(start_time)
+        .order_by("id")
+    )
+
+    for car in available_cars:
+        branch_to_cars[car.current_branch_id].append(car)
+    if record:
+        started = record.add_stage("candidates", started, rows=len(available_cars))
 
     next_reservations = {
         res.car_id: res
@@ -40,6 +66,10 @@ def get_available_cars(start_time, end_time, pickup_branch, return_branch):
             car__in=available_cars
         )
     }
+    if record:
+        started = record.add_stage(
+            "next_reservations", started, rows=len(next_reservations)
+        )
 
     previous_reservations = {
         res.car_id: res
@@ -47,92 +77,421 @@ def get_available_cars(start_time, end_time, pickup_branch, return_branch):
             car__in=available_cars
         )
     }
+    if record:
+        record.add_stage(
+            "previous_reservations", started, rows=len(previous_reservations)
+        )
 
-    for car in available_cars:
-        branch_to_cars[car.current_branch_id].append(car)
+    # cars at the pickup branch first, then the other branches
+    cars = itertools.chain(
+        branch_to_cars.pop(pickup_branch.id, ()), *branch_to_cars.values()
+    )
+    yield from feasible_cars(
+        cars,
+        next_reservations,
+        previous_reservations,
+        start_time,
+        end_time,
+        pickup_branch,
+        return_branch,
+    )
 
-    # print("SEARCHING IN THE CURRENT BRANCH...")
-    for car in branch_to_cars[pickup_branch.id]:
-        res = next_reservations.get(car.id, None)
-        if not res or is_car_available_upper_bound(res, end_time, return_branch):
-            yield car
-    # print("NO CAR AVAILABLE AT CURRENT BRANCH")
-    # print("SEARCHING IN OTHER BRANCHES...")
 
-    for branch_id, cars in branch_to_cars.items():
-        if branch_id == pickup_branch.id:
-            continue
+def feasible_cars(
+    cars,
+    next_reservations,
+    previous_reservations,
+    start_time,
+    end_time,
+    pickup_branch,
+    return_branch,
+):
+    """Yield the ``cars`` that can fit the reservation between their neighbours.
 
+    Every car must reach ``return_branch`` before its next reservation.
+    Cars away from ``pickup_branch`` must also get there after their
+    previous reservation.
+    """
+    record = current_operation.get()
+    started = time.perf_counter() if record else None
+
+    yielded = pruned_by_next = pruned_by_previous = 0
+    try:
         for car in cars:
             res = next_reservations.get(car.id, None)
             if res and not is_car_available_upper_bound(res, end_time, return_branch):
+                pruned_by_next += 1
                 continue
-            res = previous_reservations.get(car.id, None)
-            if res and not is_car_available_lower_bound(res, start_time, pickup_branch):
-                continue
+            if car.current_branch_id != pickup_branch.id:
+                res = previous_reservations.get(car.id, None)
+                if res and not is_car_available_lower_bound(
+                    res, start_time, pickup_branch
+                ):
+                    pruned_by_previous += 1
+                    continue
+            yielded += 1
             yield car
+    finally:
+        if record:
+            record.add_stage(
+                "feasibility",
+                started,
+                rows=yielded,
+                next_reservation=pruned_by_next,
+                previous_reservation=pruned_by_previous,
+            )
 
 
-def reserve_car(start_time, end_time, pickup_branch, return_branch):
-    cars = get_available_cars(start_time, end_time, pickup_branch, return_branch)
-    car = next(cars, None)
+def get_available_cars_lazy(start_time, end_time, pickup_branch, return_branch):
+    """Visit the branches nearest to ``pickup_branch`` first, one at a time.
 
-    if not car:
-        return None
+    The cars of a branch are read when it is reached, through the branch
+    indexes of ``CarLocation`` and ``CarTransition`` (``staying_at``), in
+    batches together with their neighbouring reservations. Only cars those
+    tables cannot place, such as cars without any branch log, get their
+    branch computed up front. A consumer that stops at the first car reads
+    only the nearest branches. Branches without a route to ``pickup_branch``
+    come last, then cars without a branch.
+    """
+    record = current_operation.get()
+    started = time.perf_counter() if record else None
+
+    unplaced = defaultdict(list)
+    for car_id, branch_id in (
+        Car.objects.without_stay(start_time)
+        .with_current_branch(start_time)
+        .order_by("id")
+        .values_list("id", "current_branch_id")
+    ):
+        unplaced[branch_id].append(car_id)
+    if record:
+        record.add_stage("unplaced", started, rows=sum(map(len, unplaced.values())))
+
+    branch_ids = [
+        branch_id for _, branch_id in Distance.objects.matrix().neighbors(pickup_branch)
+    ]
+
+    def other_branch_ids():
+        other_branches = Branch.objects.exclude(id__in=branch_ids).order_by("id")
+        yield from other_branches.values_list("id", flat=True)
+        if unplaced[None]:
+            yield None
+
+    candidates = Car.objects.available_cars(start_time, end_time).order_by("id")
+    for branch_id in itertools.chain(branch_ids, other_branch_ids()):
+        at_branch = candidates.filter(id__in=unplaced[branch_id])
+        if branch_id is not None:
+            at_branch |= candidates.staying_at(start_time, branch_id)
+
+        last_id = 0
+        while True:
+            if record:
+                started = time.perf_counter()
+            cars = list(at_branch.filter(id__gt=last_id)[:SEARCH_BATCH_SIZE])
+            for car in cars:
+                car.current_branch_id = branch_id
+            if record:
+                started = record.add_stage("candidates", started, rows=len(cars))
+            if not cars:
+                break
+            last_id = cars[-1].id
+
+            next_reservations = {
+                res.car_id: res
+                for res in Reservation.objects.next_reservations(end_time).filter(
+                    car__in=cars
+                )
+            }
+            if record:
+                started = record.add_stage(
+                    "next_reservations", started, rows=len(next_reservations)
+                )
+
+            previous_reservations = {}
+            if branch_id != pickup_branch.id:
+                previous_reservations = {
+                    res.car_id: res
+                    for res in Reservation.objects.previous_reservations(
+                        start_time
+                    ).filter(car__in=cars)
+                }
+                if record:
+                    record.add_stage(
+                        "previous_reservations",
+                        started,
+                        rows=len(previous_reservations),
+                    )
+
+            yield from feasible_cars(
+                cars,
+                next_reservations,
+                previous_reservations,
+                start_time,
+                end_time,
+                pickup_branch,
+                return_branch,
+            )
+            if len(cars) < SEARCH_BATCH_SIZE:
+                break
+
+
+def ranked_available_cars(
+    start_time, end_time, pickup_branch, return_branch, distances
+):
+    """Return the available cars ranked by distance to ``pickup_branch``.
+
+    Transfer times only depend on the branch pair, so the lower and upper
+    bound checks are expressed as one deadline per branch and compared
+    against the neighbouring reservations inside the query.
+    """
+    previous_ok = Q(return_branch_id=pickup_branch.id)
+    next_ok = Q(pickup_branch_id=return_branch.id)
+    ranks = {pickup_branch.id: 0}
 
-    return Reservation.objects.create(
-        car=car,
-        start_time=start_time,
-        end_time=end_time,
-        pickup_branch=pickup_branch,
-        return_branch=return_branch,
+    for (from_branch_id, to_branch_id), distance_km in distances.distances.items():
+        transfer_time = distances.transfer_time(from_branch_id, to_branch_id)
+        if to_branch_id == pickup_branch.id:
+            ranks[from_branch_id] = distance_km
+            if transfer_time:
+                previous_ok |= Q(
+                    return_branch_id=from_branch_id,
+                    end_time__lte=start_time - transfer_time,
+                )
+        if to_branch_id == return_branch.id and transfer_time:
+            next_ok |= Q(
+                pickup_branch_id=from_branch_id,
+                start_time__gte=end_time + transfer_time,
+            )
+
+    return (
+        Car.objects.available_cars(start_time, end_time)
+        .with_current_branch(start_time)
+        .with_branch_rank(start_time, ranks)
+        .with_reservation_checks(start_time, end_time, previous_ok, next_ok)
+        .filter(Q(current_branch_id=pickup_branch.id) | Q(previous_reservation_ok=True))
+        .filter(next_reservation_ok=True)
+        .order_by(F("branch_rank").asc(nulls_last=True), "id")
+    )
+
+
+def get_available_cars_sql(start_time, end_time, pickup_branch, return_branch):
+    """Run the whole availability test as a single ranked SQL statement.
+
+    See ``ranked_available_cars`` for the statement.
+    """
+    record = current_operation.get()
+    started = time.perf_counter() if record else None
+
+    distances = Distance.objects.matrix()
+    cars = ranked_available_cars(
+        start_time, end_time, pickup_branch, return_branch, distances
     )
+    if record:
+        started = record.add_stage("distances", started, rows=len(distances.distances))
+
+    # one statement read SEARCH_BATCH_SIZE rows at a time, so a consumer that
+    # stops early skips the rest and every car is read from the same result
+    yielded = 0
+    try:
+        for car in cars.iterator(chunk_size=SEARCH_BATCH_SIZE):
+            yielded += 1
+            yield car
+    finally:
+        if record:
+            record.add_stage("ranked_query", started, rows=yielded)
 
 
-def get_nearest_car(pickup_branch, cars):
-    nearest_car = None
-    nearest_distance = float("inf")
+def get_available_cars_memory(start_time, end_time, pickup_branch, return_branch):
+    """Answer from ``fleet_timeline`` without querying the database.
 
-    for car in cars:
-        car_branch = Branch.objects.get(id=car.current_branch_id)
-        distance = Distance.objects.distance_km(
-            from_branch=car_branch, to_branch=pickup_branch
+    Until the timeline has been warmed the sql engine answers instead.
+    """
+    if not fleet_timeline.is_warm():
+        return get_available_cars_sql(
+            start_time, end_time, pickup_branch, return_branch
         )
 
-        if distance is None:
-            raise GraphQLError("No distance between the branches.")
+    return fleet_timeline.available_cars(
+        start_time,
+        end_time,
+        pickup_branch,
+        return_branch,
+        Distance.objects.matrix(),
+        current_operation.get(),
+    )
 
-        if distance < nearest_distance:
-            nearest_distance = distance
-            nearest_car = car
 
-    return nearest_car
+SEARCH_ENGINES = {
+    "python": get_available_cars_python,
+    "sql": get_available_cars_sql,
+    "lazy": get_available_cars_lazy,
+    "memory": get_available_cars_memory,
+}
 
 
-@transaction.atomic
-def reserve_cars(reservation_request_list):
-    reservations = []
-    reservation_request_list.sort(key=lambda x: x[0])
+def search_available_cars(start_time, end_time, pickup_branch, return_branch):
+    """Yield available cars, serving the search window from the cache first.
 
-    for reservation_request in reservation_request_list:
-        start_time, end_time, pickup_branch, return_branch = reservation_request
+    With ``CARS_AVAILABILITY_CACHE`` the cars found for the bucketed window
+    are looked up in ``availability_cache``. Hits are re-checked per batch of
+    cars with the sql engine's overlap and transfer time checks, so cars
+    booked since by another process are skipped. On a miss the first
+    ``SEARCH_BATCH_SIZE`` cars of the bucketed window are read and stored
+    before any is yielded, so a consumer that stops at the first car still
+    fills the cache, and the rest of the window is streamed lazily. Once the
+    cached cars run out the exact search yields the cars they do not cover.
+    """
+    if not settings.CARS_AVAILABILITY_CACHE:
+        yield from get_available_cars(
+            start_time, end_time, pickup_branch, return_branch
+        )
+        return
 
-        cars = list(
-            get_available_cars(start_time, end_time, pickup_branch, return_branch)
+    key = availability_cache.key(start_time, end_time, pickup_branch, return_branch)
+    car_ids = availability_cache.get(key)
+    yielded = set()
+    if car_ids is None:
+        cars = get_available_cars(
+            *bucket_window(start_time, end_time), pickup_branch, return_branch
+        )
+        first_batch = list(itertools.islice(cars, SEARCH_BATCH_SIZE))
+        availability_cache.set(key, [car.id for car in first_batch])
+        for car in itertools.chain(first_batch, cars):
+            yielded.add(car.id)
+            yield car
+    else:
+        record = current_operation.get()
+        available_cars = ranked_available_cars(
+            start_time,
+            end_time,
+            pickup_branch,
+            return_branch,
+            Distance.objects.matrix(),
         )
+        for offset in range(0, len(car_ids), SEARCH_BATCH_SIZE):
+            if record:
+                started = time.perf_counter()
+            batch = car_ids[offset : offset + SEARCH_BATCH_SIZE]
+            cars = {car.id: car for car in available_cars.filter(id__in=batch)}
+            rejected = set(batch).difference(cars)
+            if rejected:
+                availability_cache.reject(rejected)
+            if record:
+                record.add_stage(
+                    "cached_cars", started, rows=len(cars), rejected=len(rejected)
+                )
+            for car_id in batch:
+                if car_id in cars:
+                    yielded.add(car_id)
+                    yield cars[car_id]
 
-        if not cars:
-            return []
+    for car in get_available_cars(start_time, end_time, pickup_branch, return_branch):
+        if car.id not in yielded:
+            yield car
 
-        car = get_nearest_car(pickup_branch, cars)
 
-        reservation = Reservation.objects.create(
-            car=car,
-            start_time=start_time,
-            end_time=end_time,
-            pickup_branch=pickup_branch,
-            return_branch=return_branch,
-        )
-        reservations.append(reservation)
+def is_car_still_available(car, start_time, end_time, pickup_branch, return_branch):
+    """Repeat the availability checks of the search for a single car."""
+    if Car.objects.reserved_cars(start_time, end_time).filter(pk=car.pk).exists():
+        return False
+
+    res = Reservation.objects.next_reservations(end_time).filter(car=car).first()
+    if res and not is_car_available_upper_bound(res, end_time, return_branch):
+        return False
+
+    if car.current_branch_id == pickup_branch.id:
+        return True
+
+    res = Reservation.objects.previous_reservations(start_time).filter(car=car).first()
+    return not res or is_car_available_lower_bound(res, start_time, pickup_branch)
+
+
+def lock_car(car):
+    """Lock the car row until the end of the transaction.
+
+    SQLite has no row locks. Writing the row first takes the database write
+    lock before anything is read, so the transaction waits on the busy
+    timeout instead of failing when it upgrades from reading to writing.
+    Returns False if the car no longer exists.
+    """
+    if connection.vendor == "sqlite":
+        return Car.objects.filter(pk=car.pk).update(id=F("id")) == 1
+    return Car.objects.select_for_update().filter(pk=car.pk).exists()
+
+
+def try_reserve_car(car, start_time, end_time, pickup_branch, return_branch):
+    """Reserve ``car`` unless another booking took it since it was found.
+
+    With ``CARS_RESERVATION_CHECK = "constraint"`` on a backend that has the
+    overlap constraint, the insert is attempted directly and the database
+    rejects overlapping bookings. Cars found by the memory engine may come
+    from a copy that missed other processes' bookings, so their transfer
+    times are checked against the database first. Otherwise the car row is
+    locked with ``lock_car`` before the checks are repeated, so concurrent
+    reservations of the same car are serialized.
+    """
+    if settings.CARS_RESERVATION_CHECK == "constraint" and has_overlap_constraint(
+        connection
+    ):
+        if settings.CARS_SEARCH_ENGINE == "memory" and not is_car_still_available(
+            car, start_time, end_time, pickup_branch, return_branch
+        ):
+            return None
+        try:
+            with transaction.atomic():
+                return Reservation.objects.create(
+                    car=car,
+                    start_time=start_time,
+                    end_time=end_time,
+                    pickup_branch=pickup_branch,
+                    return_branch=return_branch,
+                )
+        except IntegrityError as error:
+            if is_overlap_conflict(error):
+                return None
+            raise
+
+    try:
+        with transaction.atomic():
+            if not lock_car(car):
+                return None
+            if not is_car_still_available(
+                car, start_time, end_time, pickup_branch, return_branch
+            ):
+                return None
+            return Reservation.objects.create(
+                car=car,
+                start_time=start_time,
+                end_time=end_time,
+                pickup_branch=pickup_branch,
+                return_branch=return_branch,
+            )
+    except IntegrityError:
+        return None
+
+
+def reserve_car(start_time, end_time, pickup_branch, return_branch):
+    """Reserve the first available car, moving on to the next on conflicts.
 
-    return reservations
+    A search or write that cannot get the database lock is retried.
+    """
+    for attempt in range(RESERVE_RETRIES):
+        try:
+            cars = section_iter(
+                "search",
+                search_available_cars(
+                    start_time, end_time, pickup_branch, return_branch
+                ),
+            )
+            for car in cars:
+                with section("insert"):
+                    reservation = try_reserve_car(
+                        car, start_time, end_time, pickup_branch, return_branch
+                    )
+                if reservation:
+                    return reservation
+            return None
+        except OperationalError:
+            if attempt == RESERVE_RETRIES - 1:
+                raise
+            time.sleep(RESERVE_RETRY_DELAY * (attempt + 1))
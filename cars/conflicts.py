@@ -0,0 +1,31 @@
+from django.db import IntegrityError
+
+# Name of the constraint (PostgreSQL) and trigger error (SQLite) installed by
+# migrations 0006 and 0007 that rejects overlapping reservations of the same
+# car.
+OVERLAP_CONSTRAINT = "cars_reservation_no_overlap"
+OVERLAP_CONSTRAINT_VENDORS = ("postgresql", "sqlite")
+
+# PostgreSQL checks the (car, start_time, end_time) unique constraint before
+# the exclusion constraint, so an identical booking violates that one instead.
+DUPLICATE_CONSTRAINT = "cars_reservation_unique_window"
+
+
+def has_overlap_constraint(connection):
+    return connection.vendor in OVERLAP_CONSTRAINT_VENDORS
+
+
+def violated_constraint(error):
+    """Return the constraint name the driver reports for ``error``, if any."""
+    diag = getattr(error.__cause__, "diag", None)
+    return getattr(diag, "constraint_name", None)
+
+
+def is_overlap_conflict(error):
+    if not isinstance(error, IntegrityError):
+        return False
+    constraint = violated_constraint(error)
+    if constraint is not None:
+        return constraint in (OVERLAP_CONSTRAINT, DUPLICATE_CONSTRAINT)
+    # SQLite only reports the message the trigger aborts with
+    return str(error) == OVERLAP_CONSTRAINT
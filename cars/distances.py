@@ -0,0 +1,149 @@
+import datetime
+import heapq
+import threading
+
+
+def branch_id(branch):
+    return getattr(branch, "pk", branch)
+
+
+def shortest_paths(edges):
+    """All-pairs shortest distances over ``edges`` by Dijkstra from every branch."""
+    graph = {}
+    for (from_branch_id, to_branch_id), distance_km in edges.items():
+        graph.setdefault(from_branch_id, {})[to_branch_id] = distance_km
+
+    distances = {}
+    for source in graph:
+        visited = {}
+        queue = [(0, source)]
+        while queue:
+            distance_km, node = heapq.heappop(queue)
+            if node in visited:
+                continue
+            visited[node] = distance_km
+            for neighbor, edge_km in graph.get(node, {}).items():
+                if neighbor not in visited:
+                    heapq.heappush(queue, (distance_km + edge_km, neighbor))
+
+        for node, distance_km in visited.items():
+            if node != source:
+                distances[(source, node)] = distance_km
+
+    return distances
+
+
+class DistanceTable:
+    """Immutable snapshot of the branch distance graph keyed by branch ids.
+
+    ``direct`` holds the ``Distance`` rows, ``distances`` the shortest route
+    between every pair of connected branches. ``neighbors`` ranks the
+    branches by their distance to a pickup branch.
+    """
+
+    def __init__(self, rows, car_speed, distances=None):
+        self.car_speed = car_speed
+        self.direct = {
+            (from_branch_id, to_branch_id): distance_km
+            for from_branch_id, to_branch_id, distance_km in rows
+        }
+        if distances is None:
+            distances = shortest_paths(self.direct)
+        self.distances = distances
+        self._neighbors = None
+
+    def distance_km(self, from_branch, to_branch):
+        return self.distances.get((branch_id(from_branch), branch_id(to_branch)))
+
+    def neighbors(self, to_branch):
+        """Return ``(distance_km, branch_id)`` of the branches reaching ``to_branch``.
+
+        The list is sorted nearest first and starts with ``to_branch`` itself
+        at 0 km. The lists of all branches are built on the first call.
+        """
+        if self._neighbors is None:
+            neighbors = {}
+            for (from_branch_id, to_branch_id), distance_km in self.distances.items():
+                neighbors.setdefault(to_branch_id, []).append(
+                    (distance_km, from_branch_id)
+                )
+            for ranked in neighbors.values():
+                ranked.sort()
+            self._neighbors = neighbors
+
+        to_branch_id = branch_id(to_branch)
+        return [(0, to_branch_id), *self._neighbors.get(to_branch_id, ())]
+
+    def transfer_time(self, from_branch, to_branch):
+        distance_km = self.distance_km(from_branch, to_branch)
+        if distance_km is None:
+            return None
+
+        return datetime.timedelta(hours=distance_km / self.car_speed)
+
+    def with_distance(self, from_branch_id, to_branch_id, distance_km):
+        """Return a table with the edge added, or None if it needs a rebuild.
+
+        A new or shortened edge can only shorten routes through it, so every
+        pair is relaxed via ``from -> to`` in O(n^2). A longer edge may break
+        existing routes and requires recomputing from scratch.
+        """
+        key = (from_branch_id, to_branch_id)
+        if key in self.direct and self.direct[key] < distance_km:
+            return None
+
+        sources = [(from_branch_id, 0)]
+        targets = [(to_branch_id, 0)]
+        for (source, target), route_km in self.distances.items():
+            if target == from_branch_id:
+                sources.append((source, route_km))
+            if source == to_branch_id:
+                targets.append((target, route_km))
+
+        distances = dict(self.distances)
+        for source, source_km in sources:
+            for target, target_km in targets:
+                if source == target:
+                    continue
+                route_km = source_km + distance_km + target_km
+                if route_km < distances.get((source, target), float("inf")):
+                    distances[(source, target)] = route_km
+
+        rows = [(*edge, km) for edge, km in self.direct.items() if edge != key]
+        rows.append((from_branch_id, to_branch_id, distance_km))
+        return DistanceTable(rows, self.car_speed, distances)
+
+
+class DistanceCache:
+    """Process-wide holder of the current ``DistanceTable``.
+
+    The table is built lazily by ``loader``. The ``Distance`` and ``Branch``
+    signal handlers either patch it through ``update`` or drop it with
+    ``clear``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._table = None
+
+    def get(self, loader):
+        table = self._table
+        if table is not None:
+            return table
+
+        with self._lock:
+            if self._table is None:
+                self._table = loader()
+            return self._table
+
+    def update(self, change):
+        with self._lock:
+            if self._table is not None:
+                self._table = change(self._table)
+
+    def clear(self):
+        with self._lock:
+            self._table = None
+
+
+distance_cache = DistanceCache()
@@ -0,0 +1,90 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from graphql import GraphQLError, parse, specified_rules, validate
+
+
+def query_hash(query):
+    """Return the hash automatic persisted queries identify ``query`` by."""
+    return hashlib.sha256(query.encode()).hexdigest()
+
+
+class PersistedQueryNotFound(GraphQLError):
+    def __init__(self):
+        super().__init__(
+            "PersistedQueryNotFound",
+            extensions={"code": "PERSISTED_QUERY_NOT_FOUND"},
+        )
+
+
+class DocumentCache:
+    """LRU cache of parsed and validated GraphQL documents.
+
+    Entries are keyed by the sha256 of the query text, which is also the hash
+    clients send for automatic persisted queries, so a cached document can be
+    requested by its hash alone. The cache holds up to
+    ``CARS_DOCUMENT_CACHE_SIZE`` documents.
+    """
+
+    def __init__(self):
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, schema, query=None, sha256_hash=None, rules=()):
+        """Return the document and validation errors for a query.
+
+        Either ``query`` or its ``sha256_hash`` must be given. Documents are
+        validated with graphql-core's ``specified_rules`` followed by
+        ``rules``, which are part of the cache key. Raises
+        ``PersistedQueryNotFound`` for an unknown hash without a query, and
+        lets syntax errors of ``query`` propagate.
+        """
+        rules = tuple(rules)
+        if query is not None:
+            key = query_hash(query)
+            if sha256_hash is not None and sha256_hash != key:
+                raise GraphQLError("provided sha does not match query")
+        else:
+            key = sha256_hash
+
+        with self.lock:
+            entry = self.entries.get((schema, rules, key))
+            if entry is not None:
+                self.entries.move_to_end((schema, rules, key))
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        if query is None:
+            raise PersistedQueryNotFound()
+
+        document = parse(query)
+        entry = document, validate(schema, document, (*specified_rules, *rules))
+
+        with self.lock:
+            self.entries[(schema, rules, key)] = entry
+            while len(self.entries) > settings.CARS_DOCUMENT_CACHE_SIZE:
+                self.entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_size": settings.CARS_DOCUMENT_CACHE_SIZE,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+document_cache = DocumentCache()
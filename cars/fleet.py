@@ -0,0 +1,469 @@
+import bisect
+import datetime
+import threading
+import time
+from array import array
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connections
+from cars.models import Car, CarBranchLog, Reservation
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+COLD, WARMING, WARM = "cold", "warming", "warm"
+
+
+def microseconds(date_time):
+    return (date_time - EPOCH) // MICROSECOND
+
+
+class CarSchedule:
+    """Reservations and branch transitions of one car as parallel arrays.
+
+    Reservations are sorted by start and hold their id, start, end, pickup
+    and return branch; transitions hold the id, timestamp and branch of the
+    car's ``CarBranchLog`` entries. Times are microseconds since the epoch.
+    Schedules are never changed in place: the ``with_*`` and ``without_*``
+    methods return a new schedule, so searches can read them unlocked.
+    """
+
+    __slots__ = (
+        "ids",
+        "starts",
+        "ends",
+        "pickups",
+        "returns",
+        "log_ids",
+        "log_times",
+        "log_branches",
+    )
+
+    def __init__(
+        self,
+        ids=(),
+        starts=(),
+        ends=(),
+        pickups=(),
+        returns=(),
+        log_ids=(),
+        log_times=(),
+        log_branches=(),
+    ):
+        self.ids = array("q", ids)
+        self.starts = array("q", starts)
+        self.ends = array("q", ends)
+        self.pickups = array("q", pickups)
+        self.returns = array("q", returns)
+        self.log_ids = array("q", log_ids)
+        self.log_times = array("q", log_times)
+        self.log_branches = array("q", log_branches)
+
+    def copy(self):
+        return CarSchedule(*(getattr(self, name) for name in self.__slots__))
+
+    def branch_at(self, time_us):
+        """Return the branch of the last transition before ``time_us``, or None."""
+        log_times = self.log_times
+        if not log_times:
+            return None
+        if log_times[-1] < time_us:
+            return self.log_branches[-1]
+
+        index = bisect.bisect_left(log_times, time_us)
+        return self.log_branches[index - 1] if index else None
+
+    def with_reservation(self, id, start, end, pickup, returned):
+        schedule = self.without_reservation(id)
+        index = bisect.bisect_right(schedule.starts, start)
+        for name, value in zip(
+            ("ids", "starts", "ends", "pickups", "returns"),
+            (id, start, end, pickup, returned),
+        ):
+            getattr(schedule, name).insert(index, value)
+        return schedule
+
+    def without_reservation(self, id):
+        schedule = self.copy()
+        if id in schedule.ids:
+            index = schedule.ids.index(id)
+            for name in ("ids", "starts", "ends", "pickups", "returns"):
+                del getattr(schedule, name)[index]
+        return schedule
+
+    def with_log(self, id, timestamp, branch):
+        schedule = self.without_log(id)
+        index = bisect.bisect_right(schedule.log_times, timestamp)
+        for name, value in zip(
+            ("log_ids", "log_times", "log_branches"), (id, timestamp, branch)
+        ):
+            getattr(schedule, name).insert(index, value)
+        return schedule
+
+    def without_log(self, id):
+        schedule = self.copy()
+        if id in schedule.log_ids:
+            index = schedule.log_ids.index(id)
+            for name in ("log_ids", "log_times", "log_branches"):
+                del getattr(schedule, name)[index]
+        return schedule
+
+
+class FleetTimeline:
+    """In-process copy of every car's schedule for the "memory" search engine.
+
+    ``warm`` loads the cars, reservations and branch logs. The model signals
+    then keep the copy current once their transactions commit; changes made
+    while warming are replayed when loading finishes. Reservations and logs
+    are tracked by id together with their car, so an update that moves one
+    to another car removes it from the old car's schedule. Signals only reach the
+    process that made the change, so the copy expires after
+    ``CARS_FLEET_TIMELINE_TTL`` seconds and is reloaded in the background to
+    pick up the changes of other processes. Searches read the
+    schedules without locks, which is safe because a schedule is replaced
+    rather than changed and the mapping itself is replaced when cars are
+    added or removed. The same holds for the sorted car ids kept per branch
+    a car has a log at, which let a search start at the pickup branch
+    without first looking at every car.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = COLD
+        self._pending = []
+        self._loaded_at = None
+        self._schedules = {}
+        self._cars = {}
+        # "reservation" / "log" -> entry id -> car id
+        self._entry_cars = {"reservation": {}, "log": {}}
+        # branch id -> sorted ids of the cars with a log at the branch
+        self._branch_cars = {}
+        self._car_fields = [field.attname for field in Car._meta.concrete_fields]
+
+    def is_warm(self):
+        """Return whether the copy is loaded and has not expired.
+
+        An expired copy starts reloading in the background.
+        """
+        if self._state != WARM:
+            return False
+        if time.monotonic() - self._loaded_at < settings.CARS_FLEET_TIMELINE_TTL:
+            return True
+        self.warm_in_background()
+        return False
+
+    def warm(self):
+        """Load the fleet from the database, replacing the current copy."""
+        with self._lock:
+            self._start_warming()
+        self._fill()
+
+    def _start_warming(self):
+        self._state = WARMING
+        self._pending = []
+
+    def _fill(self):
+        loaded_at = time.monotonic()
+        try:
+            cars, schedules, entry_cars, branch_cars = self._load()
+        except Exception:
+            self.reset()
+            raise
+
+        with self._lock:
+            self._cars = cars
+            self._schedules = schedules
+            self._entry_cars = entry_cars
+            self._branch_cars = branch_cars
+            for change, args in self._pending:
+                change(*args)
+            self._pending = []
+            self._loaded_at = loaded_at
+            self._state = WARM
+
+    def _load(self):
+        cars = {
+            row[0]: row
+            for row in Car.objects.order_by("id")
+            .values_list(*self._car_fields)
+            .iterator(chunk_size=5000)
+        }
+        columns = defaultdict(lambda: defaultdict(list))
+        entry_cars = {"reservation": {}, "log": {}}
+        for car_id, *values in (
+            Reservation.objects.order_by("car_id", "start_time")
+            .values_list(
+                "car_id",
+                "id",
+                "start_time",
+                "end_time",
+                "pickup_branch_id",
+                "return_branch_id",
+            )
+            .iterator(chunk_size=5000)
+        ):
+            entry_cars["reservation"][values[0]] = car_id
+            values[1] = microseconds(values[1])
+            values[2] = microseconds(values[2])
+            for name, value in zip(
+                ("ids", "starts", "ends", "pickups", "returns"), values
+            ):
+                columns[car_id][name].append(value)
+        for car_id, log_id, timestamp, branch_id in (
+            CarBranchLog.objects.order_by("car_id", "timestamp", "id")
+            .values_list("car_id", "id", "timestamp", "branch_id")
+            .iterator(chunk_size=5000)
+        ):
+            entry_cars["log"][log_id] = car_id
+            columns[car_id]["log_ids"].append(log_id)
+            columns[car_id]["log_times"].append(microseconds(timestamp))
+            columns[car_id]["log_branches"].append(branch_id)
+
+        schedules = {car_id: CarSchedule(**columns.get(car_id, {})) for car_id in cars}
+        branch_cars = defaultdict(lambda: array("q"))
+        for car_id, schedule in schedules.items():
+            for branch_id in set(schedule.log_branches):
+                branch_cars[branch_id].append(car_id)
+        return cars, schedules, entry_cars, dict(branch_cars)
+
+    def warm_in_background(self):
+        """Start warming in a thread unless the timeline is already warming."""
+        with self._lock:
+            if self._state == WARMING:
+                return
+            self._start_warming()
+
+        def run():
+            try:
+                self._fill()
+            finally:
+                connections.close_all()
+
+        threading.Thread(target=run, name="fleet-timeline", daemon=True).start()
+
+    def reset(self):
+        with self._lock:
+            self._state = COLD
+            self._pending = []
+            self._loaded_at = None
+            self._schedules = {}
+            self._cars = {}
+            self._entry_cars = {"reservation": {}, "log": {}}
+            self._branch_cars = {}
+
+    def stats(self):
+        schedules = list(self._schedules.values())
+        return {
+            "state": self._state,
+            "cars": len(schedules),
+            "reservations": sum(len(schedule.ids) for schedule in schedules),
+            "branch_logs": sum(len(schedule.log_times) for schedule in schedules),
+        }
+
+    # Changes, applied from the model signals after commit.
+
+    def save_car(self, car):
+        row = tuple(getattr(car, name) for name in self._car_fields)
+        self._apply(self._save_car, row)
+
+    def delete_car(self, car_id):
+        self._apply(self._delete_car, car_id)
+
+    def save_reservation(self, reservation):
+        self._apply(
+            self._save_entry,
+            "reservation",
+            reservation.car_id,
+            reservation.id,
+            microseconds(reservation.start_time),
+            microseconds(reservation.end_time),
+            reservation.pickup_branch_id,
+            reservation.return_branch_id,
+        )
+
+    def delete_reservation(self, reservation_id):
+        self._apply(self._delete_entry, "reservation", reservation_id)
+
+    def save_log(self, log):
+        self._apply(
+            self._save_entry,
+            "log",
+            log.car_id,
+            log.id,
+            microseconds(log.timestamp),
+            log.branch_id,
+        )
+
+    def delete_log(self, log_id):
+        self._apply(self._delete_entry, "log", log_id)
+
+    def _apply(self, change, *args):
+        if self._state == COLD:
+            return
+
+        with self._lock:
+            if self._state == WARMING:
+                self._pending.append((change, args))
+            elif self._state == WARM:
+                change(*args)
+
+    def _save_car(self, row):
+        if row[0] not in self._cars:
+            self._schedules = {**self._schedules, row[0]: CarSchedule()}
+        self._cars = {**self._cars, row[0]: row}
+
+    def _delete_car(self, car_id):
+        cars = dict(self._cars)
+        schedules = dict(self._schedules)
+        cars.pop(car_id, None)
+        schedule = schedules.pop(car_id, None)
+        self._cars = cars
+        self._schedules = schedules
+        if schedule is not None:
+            self._index(car_id, schedule, CarSchedule())
+            for kind, ids in (("reservation", schedule.ids), ("log", schedule.log_ids)):
+                for id in ids:
+                    self._entry_cars[kind].pop(id, None)
+
+    def _save_entry(self, kind, car_id, id, *values):
+        entry_cars = self._entry_cars[kind]
+        previous_car_id = entry_cars.get(id)
+        if previous_car_id is not None and previous_car_id != car_id:
+            self._change(previous_car_id, f"without_{kind}", id)
+            del entry_cars[id]
+        if car_id in self._schedules:
+            entry_cars[id] = car_id
+            self._change(car_id, f"with_{kind}", id, *values)
+
+    def _delete_entry(self, kind, id):
+        car_id = self._entry_cars[kind].pop(id, None)
+        if car_id is not None:
+            self._change(car_id, f"without_{kind}", id)
+
+    def _change(self, car_id, method, *args):
+        schedule = self._schedules.get(car_id)
+        if schedule is not None:
+            changed = getattr(schedule, method)(*args)
+            self._schedules[car_id] = changed
+            self._index(car_id, schedule, changed)
+
+    def _index(self, car_id, schedule, changed):
+        """Move ``car_id`` between the branch indexes after a schedule change."""
+        branches = set(schedule.log_branches)
+        changed_branches = set(changed.log_branches)
+        for branch_id in branches - changed_branches:
+            car_ids = array("q", self._branch_cars[branch_id])
+            del car_ids[bisect.bisect_left(car_ids, car_id)]
+            self._branch_cars[branch_id] = car_ids
+        for branch_id in changed_branches - branches:
+            car_ids = array("q", self._branch_cars.get(branch_id, ()))
+            car_ids.insert(bisect.bisect_left(car_ids, car_id), car_id)
+            self._branch_cars[branch_id] = car_ids
+
+    # Search.
+
+    def available_cars(
+        self, start_time, end_time, pickup_branch, return_branch, table, record=None
+    ):
+        """Yield the available cars, nearest to ``pickup_branch`` first.
+
+        Repeats the checks of the python engine on the in-memory schedules
+        with transfer times from ``table``. Cars at the same branch come in
+        id order and branches without a route to ``pickup_branch`` come
+        next. Cars without a branch at ``start_time`` come last; only they
+        need a pass over the whole fleet. Stages are added to ``record`` if
+        one is given.
+        """
+        started = time.perf_counter() if record else None
+
+        start = microseconds(start_time)
+        end = microseconds(end_time)
+        schedules = self._schedules
+        cars = self._cars
+        branch_cars = self._branch_cars
+
+        def candidates(branch_ids):
+            for branch_id in branch_ids:
+                for car_id in branch_cars.get(branch_id, ()):
+                    # the index lists every branch the car has been at
+                    schedule = schedules.get(car_id)
+                    if schedule is not None and schedule.branch_at(start) == branch_id:
+                        yield branch_id, car_id, schedule
+            for car_id, schedule in schedules.items():
+                if schedule.branch_at(start) is None:
+                    yield None, car_id, schedule
+
+        def transfer_times(branch):
+            # microseconds to get from every other branch to ``branch``
+            transfers = {}
+            for _, from_branch_id in table.neighbors(branch)[1:]:
+                transfer = table.transfer_time(from_branch_id, branch)
+                if transfer:
+                    transfers[from_branch_id] = transfer // MICROSECOND
+            return transfers
+
+        to_pickup = transfer_times(pickup_branch)
+        to_return = transfer_times(return_branch)
+        branch_ids = [
+            branch_id
+            for _, branch_id in table.neighbors(pickup_branch)
+            if branch_id in branch_cars
+        ]
+        reachable = set(branch_ids)
+        branch_ids.extend(
+            branch_id for branch_id in list(branch_cars) if branch_id not in reachable
+        )
+
+        yielded = reserved = pruned_by_next = pruned_by_previous = 0
+        try:
+            for branch_id, car_id, schedule in candidates(branch_ids):
+                index = bisect.bisect_right(schedule.starts, end)
+                if index and schedule.ends[index - 1] >= start:
+                    reserved += 1
+                    continue
+
+                if index < len(schedule.starts):
+                    pickup = schedule.pickups[index]
+                    next_start = schedule.starts[index]
+                    transfer = to_return.get(pickup)
+                    if not (
+                        pickup == return_branch.id
+                        or transfer
+                        and end + transfer <= next_start
+                    ):
+                        pruned_by_next += 1
+                        continue
+
+                # reservations before ``index`` all end before ``start``
+                if index and branch_id != pickup_branch.id:
+                    returned = schedule.returns[index - 1]
+                    transfer = to_pickup.get(returned)
+                    if not (
+                        returned == pickup_branch.id
+                        or transfer
+                        and start - transfer >= schedule.ends[index - 1]
+                    ):
+                        pruned_by_previous += 1
+                        continue
+
+                row = cars.get(car_id)
+                if row is None:
+                    continue
+                car = Car.from_db(Car.objects.db, self._car_fields, row)
+                car.current_branch_id = branch_id
+                yielded += 1
+                yield car
+        finally:
+            if record:
+                record.add_stage(
+                    "feasibility",
+                    started,
+                    rows=yielded,
+                    reserved=reserved,
+                    next_reservation=pruned_by_next,
+                    previous_reservation=pruned_by_previous,
+                )
+
+
+fleet_timeline = FleetTimeline()
@@ -0,0 +1,167 @@
+import contextlib
+import contextvars
+import inspect
+import time
+from collections import Counter, defaultdict
+
+# OperationRecord of the GraphQL request being served, if metrics are enabled.
+current_operation = contextvars.ContextVar("current_operation", default=None)
+
+
+class OperationRecord:
+    """Measurements of one request, filled in while it is served."""
+
+    def __init__(self):
+        self.names = []
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.slowest_resolver = None
+        self.slowest_resolver_seconds = 0.0
+        # section name -> [seconds, queries]
+        self.sections = defaultdict(lambda: [0.0, 0])
+        self.active_sections = []
+        # search stage name -> {"calls", "seconds", "rows", "pruned"}
+        self.stages = {}
+
+    @property
+    def name(self):
+        return "+".join(self.names)
+
+    def add_name(self, name):
+        if name not in self.names:
+            self.names.append(name)
+
+    def add_query(self, seconds):
+        self.queries += 1
+        self.sql_seconds += seconds
+        for name in self.active_sections:
+            self.sections[name][1] += 1
+
+    def add_resolver(self, name, seconds):
+        if seconds > self.slowest_resolver_seconds:
+            self.slowest_resolver = name
+            self.slowest_resolver_seconds = seconds
+
+    def add_stage(self, stage, started, rows=0, **pruned):
+        """Add a run of search ``stage`` begun at ``started``; return the time now.
+
+        A stage's time runs until the stage is done; for the feasibility
+        checks that includes the time the consumer takes between cars.
+        """
+        finished = time.perf_counter()
+        totals = self.stages.setdefault(
+            stage, {"calls": 0, "seconds": 0.0, "rows": 0, "pruned": Counter()}
+        )
+        totals["calls"] += 1
+        totals["seconds"] += finished - started
+        totals["rows"] += rows
+        totals["pruned"].update(pruned)
+        return finished
+
+    def as_dict(self, seconds):
+        return {
+            "operation": self.name,
+            "seconds": round(seconds, 6),
+            "queries": self.queries,
+            "sql_seconds": round(self.sql_seconds, 6),
+            "slowest_resolver": self.slowest_resolver,
+            "slowest_resolver_seconds": round(self.slowest_resolver_seconds, 6),
+            "sections": {
+                name: {"seconds": round(section_seconds, 6), "queries": queries}
+                for name, (section_seconds, queries) in self.sections.items()
+            },
+        }
+
+
+def record_query(execute, sql, params, many, context):
+    """``execute_wrapper`` counting the queries and SQL time of the operation."""
+    record = current_operation.get()
+    if record is None:
+        return execute(sql, params, many, context)
+
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        record.add_query(time.perf_counter() - started)
+
+
+def install_query_recorder(connection):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+@contextlib.contextmanager
+def profiling():
+    """Record the block as an operation of its own and yield its record.
+
+    The search engines add their stages to the record; searches outside a
+    recorded operation only pay for looking it up.
+    """
+    record = OperationRecord()
+    token = current_operation.set(record)
+    try:
+        yield record
+    finally:
+        current_operation.reset(token)
+
+
+@contextlib.contextmanager
+def section(name):
+    """Add the time and queries of the block to the operation's ``name`` section.
+
+    Does nothing outside a recorded operation or inside another ``name``
+    section.
+    """
+    record = current_operation.get()
+    if record is None or name in record.active_sections:
+        yield
+        return
+
+    record.active_sections.append(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record.active_sections.remove(name)
+        record.sections[name][0] += time.perf_counter() - started
+
+
+def section_iter(name, iterable):
+    """Yield from ``iterable``, timing the work of each step as ``name``."""
+    iterator = iter(iterable)
+    while True:
+        with section(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+class ResolverTimingMiddleware:
+    """Graphene middleware naming the operation and timing its resolvers."""
+
+    def resolve(self, next, root, info, **args):
+        record = current_operation.get()
+        if record is None:
+            return next(root, info, **args)
+
+        if info.path.prev is None:
+            operation = info.operation.name
+            record.add_name(operation.value if operation else info.field_name)
+
+        name = f"{info.parent_type.name}.{info.field_name}"
+        started = time.perf_counter()
+        result = next(root, info, **args)
+        if inspect.isawaitable(result):
+            return self.resolve_async(result, record, name, started)
+
+        record.add_resolver(name, time.perf_counter() - started)
+        return result
+
+    async def resolve_async(self, result, record, name, started):
+        try:
+            return await result
+        finally:
+            record.add_resolver(name, time.perf_counter() - started)
@@ -0,0 +1,64 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
+from cars.models import Branch, Car
+
+
+class BatchLoader:
+    """Load model instances by id, one query per batch of ids.
+
+    Under ``AsyncGraphQLView`` the items of a list are resolved in the same
+    turn of the event loop, so ``load`` only queues the id and returns a
+    future. The queue is fetched with a single ``in_bulk`` query once the
+    loop moves on, and every item's future is resolved from that query.
+    Called without a running event loop, ``load`` fetches its id directly.
+    """
+
+    def __init__(self, queryset):
+        self.queryset = queryset
+        self.futures = {}
+        self.queue = []
+
+    def load(self, key):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return self.queryset.in_bulk([key]).get(key)
+
+        future = self.futures.get(key)
+        if future is None:
+            future = self.futures[key] = loop.create_future()
+            if not self.queue:
+                loop.call_soon(lambda: loop.create_task(self.dispatch()))
+            self.queue.append(key)
+        return future
+
+    async def dispatch(self):
+        keys, self.queue = self.queue, []
+        try:
+            found = await sync_to_async(self.queryset.in_bulk)(keys)
+        except Exception as error:
+            for key in keys:
+                self.futures.pop(key).set_exception(error)
+            return
+
+        for key in keys:
+            self.futures[key].set_result(found.get(key))
+
+
+class Loaders:
+    def __init__(self):
+        self.car = BatchLoader(Car.objects.all())
+        self.branch = BatchLoader(Branch.objects.all())
+
+
+def get_loaders(info):
+    """Return the loaders of the current request, creating them on first use."""
+    context = info.context
+    if context is None:
+        return Loaders()
+
+    loaders = getattr(context, "loaders", None)
+    if loaders is None:
+        loaders = context.loaders = Loaders()
+    return loaders
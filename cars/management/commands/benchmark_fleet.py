@@ -0,0 +1,201 @@
+import datetime
+import itertools
+import json
+import platform
+import random
+import subprocess
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from django.utils.timezone import now
+from cars.allocation import reserve_cars
+from cars.benchmarks import (
+    create_branches,
+    create_cars,
+    create_distances,
+    create_history,
+    create_upcoming,
+    measure,
+    place_cars,
+)
+from cars.car_search import get_available_cars, reserve_car
+from cars.fleet import fleet_timeline
+from cars.models import Car
+from cars.schema import schema
+
+ALL_CARS_QUERY = "query { allCars { id carNumber make model } }"
+UPCOMING_RESERVATIONS_QUERY = """
+query {
+  upcomingReservations {
+    id startTime endTime
+    car { carNumber }
+    pickupBranch { city }
+    returnBranch { city }
+  }
+}
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the search, booking and list queries on a synthetic fleet "
+        "and write the results as JSON. All rows are rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--branches", type=int, default=10)
+        parser.add_argument("--cars", type=int, default=500)
+        parser.add_argument("--history", type=int, default=20000)
+        parser.add_argument("--upcoming", type=int, default=2000)
+        parser.add_argument("--batch", type=int, default=10)
+        parser.add_argument("--repeat", type=int, default=30)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="Write the results to this JSON file.")
+        parser.add_argument(
+            "--baseline", help="Compare p50 latencies with this results file."
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            try:
+                results = self.run(options)
+            finally:
+                fleet_timeline.reset()
+            transaction.set_rollback(True)
+
+        report = {
+            "commit": self.commit(),
+            "database": connection.vendor,
+            "python": platform.python_version(),
+            "options": {
+                name: options[name]
+                for name in (
+                    "branches",
+                    "cars",
+                    "history",
+                    "upcoming",
+                    "batch",
+                    "repeat",
+                    "seed",
+                )
+            },
+            "results": results,
+        }
+
+        self.write_table(results)
+        if options["baseline"]:
+            with open(options["baseline"]) as file:
+                self.write_comparison(results, json.load(file)["results"])
+        if options["output"]:
+            with open(options["output"], "w") as file:
+                json.dump(report, file, indent=2)
+
+    def run(self, options):
+        rng = random.Random(options["seed"])
+        until = now()
+
+        branches = create_branches(options["branches"])
+        create_distances(branches, rng)
+        cars = create_cars(options["cars"])
+        history_days = options["history"] // max(len(cars), 1) // 8 + 1
+        place_cars(cars, branches, until - datetime.timedelta(days=history_days))
+        create_history(cars, branches, options["history"], until)
+        create_upcoming(cars, branches, options["upcoming"], until, rng)
+        # the benchmark's own bookings reach the timeline only on commit
+        fleet_timeline.warm()
+
+        def request(hours):
+            start_time = until + datetime.timedelta(
+                days=rng.randint(1, 30), minutes=rng.randint(0, 24 * 60)
+            )
+            pickup_branch, return_branch = rng.choice(branches), rng.choice(branches)
+            end_time = start_time + datetime.timedelta(hours=hours)
+            return start_time, end_time, pickup_branch, return_branch
+
+        def search(engine, first=None):
+            def run():
+                with override_settings(CARS_SEARCH_ENGINE=engine):
+                    cars = get_available_cars(*request(24))
+                    list(itertools.islice(cars, first))
+
+            return run
+
+        def current_branches():
+            list(
+                Car.objects.with_current_branch(until).values_list(
+                    "id", "current_branch_id"
+                )
+            )
+
+        def book():
+            reserve_car(*request(24))
+
+        def book_batch():
+            reserve_cars([request(24) for _ in range(options["batch"])])
+
+        def list_query(query):
+            def run():
+                result = schema.execute(query)
+                assert not result.errors, result.errors
+
+            return run
+
+        scenarios = {
+            "search_python": search("python"),
+            "search_sql": search("sql"),
+            "search_lazy": search("lazy"),
+            "search_memory": search("memory"),
+            "first_car_python": search("python", first=1),
+            "first_car_sql": search("sql", first=1),
+            "first_car_lazy": search("lazy", first=1),
+            "first_car_memory": search("memory", first=1),
+            "with_current_branch": current_branches,
+            "reserve_car": book,
+            "reserve_cars": book_batch,
+            "all_cars": list_query(ALL_CARS_QUERY),
+            "upcoming_reservations": list_query(UPCOMING_RESERVATIONS_QUERY),
+        }
+        return {
+            name: measure(scenario, options["repeat"])
+            for name, scenario in scenarios.items()
+        }
+
+    def commit(self):
+        try:
+            return subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"],
+                capture_output=True,
+                check=True,
+                text=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def write_table(self, results):
+        self.stdout.write(
+            "scenario".ljust(24)
+            + "p50 ms".rjust(10)
+            + "p99 ms".rjust(10)
+            + "queries".rjust(9)
+            + "peak KiB".rjust(11)
+        )
+        for name, result in results.items():
+            self.stdout.write(
+                name.ljust(24)
+                + f"{result['p50_ms']:10.2f}"
+                + f"{result['p99_ms']:10.2f}"
+                + f"{result['queries']:9d}"
+                + f"{result['peak_kib']:11.1f}"
+            )
+
+    def write_comparison(self, results, baseline):
+        self.stdout.write(
+            "\n" + "scenario".ljust(24) + "baseline".rjust(10) + "change".rjust(10)
+        )
+        for name, result in results.items():
+            if name not in baseline:
+                continue
+            before = baseline[name]["p50_ms"]
+            change = (result["p50_ms"] - before) / before * 100 if before else 0.0
+            self.stdout.write(name.ljust(24) + f"{before:10.2f}" + f"{change:+9.1f}%")
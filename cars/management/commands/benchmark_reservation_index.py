@@ -0,0 +1,64 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils.timezone import now
+from cars.benchmarks import create_branches, create_cars, create_history, median_ms, timed
+from cars.models import Car, Reservation
+
+
+class Command(BaseCommand):
+    help = (
+        "Time reservation overlap and neighbour lookups while the reservation "
+        "history grows. All rows are rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", nargs="+", type=int, default=[1000, 10000, 100000]
+        )
+        parser.add_argument("--cars", type=int, default=100)
+        parser.add_argument("--repeat", type=int, default=50)
+        parser.add_argument("--explain", action="store_true")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.run(options)
+            transaction.set_rollback(True)
+
+    def run(self, options):
+        until = now()
+        branches = create_branches(2)
+        cars = create_cars(options["cars"])
+        car = cars[len(cars) // 2]
+
+        lookups = {
+            "overlap": lambda: Car.objects.reserved_cars(
+                until - datetime.timedelta(hours=1), until + datetime.timedelta(hours=1)
+            ).filter(pk=car.pk),
+            "next": lambda: Reservation.objects.next_reservations(
+                until - datetime.timedelta(hours=4)
+            ).filter(car=car),
+            "previous": lambda: Reservation.objects.previous_reservations(
+                until + datetime.timedelta(hours=1)
+            ).filter(car=car),
+        }
+
+        self.stdout.write(
+            "rows".rjust(10) + "".join(name.rjust(14) for name in lookups)
+        )
+
+        created = 0
+        for size in sorted(options["sizes"]):
+            create_history(cars, branches, size - created, until, offset=created)
+            created = size
+
+            row = str(size).rjust(10)
+            for lookup in lookups.values():
+                durations = timed(lambda: lookup().exists(), options["repeat"])
+                row += f"{median_ms(durations):11.3f} ms"
+            self.stdout.write(row)
+
+        if options["explain"]:
+            for name, lookup in lookups.items():
+                self.stdout.write(f"\n{name}:\n{lookup().explain()}")
@@ -0,0 +1,91 @@
+import datetime
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils.timezone import now
+from cars.benchmarks import create_branches, create_cars, reserve_concurrently
+from cars.models import CarBranchLog
+
+# SQLite's own defaults, i.e. the behaviour without CARS_SQLITE_PRAGMAS.
+DEFAULT_PRAGMAS = {
+    "journal_mode": "delete",
+    "synchronous": "full",
+    "busy_timeout": 0,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare concurrent reservation throughput with SQLite defaults and "
+        "with CARS_SQLITE_PRAGMAS, each on a scratch database file."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--cars", type=int, default=50)
+        parser.add_argument("--requests", type=int, default=400)
+        parser.add_argument("--threads", type=int, default=8)
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("The default database is not SQLite.")
+
+        profiles = {
+            "default": DEFAULT_PRAGMAS,
+            "tuned": settings.CARS_SQLITE_PRAGMAS,
+        }
+        self.stdout.write(
+            "profile".ljust(10)
+            + "reservations".rjust(14)
+            + "errors".rjust(8)
+            + "seconds".rjust(10)
+            + "per second".rjust(12)
+        )
+        for name, pragmas in profiles.items():
+            with override_settings(CARS_SQLITE_PRAGMAS=pragmas):
+                reservations, elapsed, errors = self.run(options)
+            self.stdout.write(
+                name.ljust(10)
+                + str(len(reservations)).rjust(14)
+                + str(len(errors)).rjust(8)
+                + f"{elapsed:10.2f}"
+                + f"{len(reservations) / elapsed:12.1f}"
+            )
+            for error in {repr(error) for error in errors}:
+                self.stderr.write(f"  {error}")
+
+    def run(self, options):
+        directory = tempfile.mkdtemp()
+        test_settings = connection.settings_dict["TEST"]
+        test_name = test_settings["NAME"]
+        test_settings["NAME"] = os.path.join(directory, "benchmark.sqlite3")
+        try:
+            old_name = connection.creation.create_test_db(
+                verbosity=0, serialize=False
+            )
+            try:
+                return self.reserve(options)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+        finally:
+            test_settings["NAME"] = test_name
+
+    def reserve(self, options):
+        branch = create_branches(1)[0]
+        for car in create_cars(options["cars"]):
+            CarBranchLog.objects.create(car=car, branch=branch, timestamp=now())
+
+        start_time = now() + datetime.timedelta(days=1)
+        requests = [
+            (
+                start_time + datetime.timedelta(hours=number),
+                start_time + datetime.timedelta(hours=number + 2),
+                branch,
+                branch,
+            )
+            for number in range(options["requests"])
+        ]
+        return reserve_concurrently(requests, options["threads"])
@@ -0,0 +1,101 @@
+import datetime
+import itertools
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_naive, make_aware, now
+from cars.allocation import BatchPlanner
+from cars.car_search import SEARCH_ENGINES, search_available_cars
+from cars.fleet import fleet_timeline
+from cars.instrumentation import profiling
+from cars.models import Branch, Car
+
+
+class Command(BaseCommand):
+    help = (
+        "Run one availability search and print the time, rows and pruned cars "
+        "of each stage. Nothing is written to the database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("pickup_branch", help="City of the pickup branch.")
+        parser.add_argument(
+            "return_branch", nargs="?", help="City of the return branch."
+        )
+        parser.add_argument(
+            "--start", help="Start time in ISO 8601, an hour from now by default."
+        )
+        parser.add_argument("--duration", type=int, default=60, help="Minutes.")
+        parser.add_argument("--engine", choices=sorted(SEARCH_ENGINES))
+        parser.add_argument(
+            "--first",
+            type=int,
+            help="Stop after this many cars, as reserve_car stops after one.",
+        )
+        parser.add_argument(
+            "--planner",
+            action="store_true",
+            help="Also plan the request with the reserve_cars planner.",
+        )
+
+    def handle(self, *args, **options):
+        pickup_branch = self.branch(options["pickup_branch"])
+        return_branch = self.branch(options["return_branch"] or pickup_branch.city)
+        start_time = self.start_time(options["start"])
+        end_time = start_time + datetime.timedelta(minutes=options["duration"])
+        engine = options["engine"] or settings.CARS_SEARCH_ENGINE
+        if engine == "memory":
+            fleet_timeline.warm()
+
+        with override_settings(CARS_SEARCH_ENGINE=engine), profiling() as profile:
+            cars = search_available_cars(
+                start_time, end_time, pickup_branch, return_branch
+            )
+            found = len(list(itertools.islice(cars, options["first"])))
+            cars.close()
+            if options["planner"]:
+                request = (start_time, end_time, pickup_branch, return_branch)
+                BatchPlanner([request]).solve()
+
+        self.stdout.write(
+            f"{engine} search, {pickup_branch.city} -> {return_branch.city}, "
+            f"{start_time.isoformat()} for {options['duration']} minutes"
+        )
+        self.stdout.write(f"{found} of {Car.objects.count()} cars found\n")
+        self.stdout.write(
+            "stage".ljust(24)
+            + "calls".rjust(7)
+            + "ms".rjust(10)
+            + "rows".rjust(9)
+            + "  pruned"
+        )
+        for stage, totals in profile.stages.items():
+            pruned = ", ".join(
+                f"{reason} {count}" for reason, count in totals["pruned"].items()
+            )
+            self.stdout.write(
+                stage.ljust(24)
+                + f"{totals['calls']:7d}"
+                + f"{totals['seconds'] * 1000:10.2f}"
+                + f"{totals['rows']:9d}"
+                + f"  {pruned}".rstrip()
+            )
+
+    def branch(self, city):
+        try:
+            return Branch.objects.get(city=city)
+        except Branch.DoesNotExist:
+            raise CommandError(f"Branch {city} does not exist.")
+
+    def start_time(self, value):
+        if value is None:
+            return now() + datetime.timedelta(hours=1)
+
+        start_time = parse_datetime(value)
+        if start_time is None:
+            raise CommandError(f"Invalid start time: {value}")
+        if is_naive(start_time):
+            start_time = make_aware(start_time)
+        return start_time
@@ -1,6 +1,16 @@
-from django.db import models
+from django.db import connections, models
+from django.db.models.functions import Coalesce
 from django.utils.timezone import now
-import datetime
+from cars.distances import DistanceTable, branch_id, distance_cache
+from cars.instrumentation import section
+
+
+def _condition(q):
+    return models.Case(
+        models.When(q, then=models.Value(True)),
+        default=models.Value(False),
+        output_field=models.BooleanField(),
+    )
 
 
 class DistanceQuerySet(models.QuerySet):
@@ -14,23 +24,24 @@ class DistanceManager(models.Manager):
     def get_queryset(self):
         return DistanceQuerySet(self.model, using=self._db)
 
-    def distance_km(self, from_branch, to_branch):
-        if from_branch == to_branch:
-            return 0
+    def matrix(self):
+        return distance_cache.get(self.load_matrix)
 
-        distance = self.get_queryset().distance(from_branch, to_branch)
+    def load_matrix(self):
+        with section("distances"):
+            rows = self.get_queryset().values_list(
+                "from_branch_id", "to_branch_id", "distance_km"
+            )
+            return DistanceTable(rows, self.CAR_SPEED)
 
-        if not distance:
-            return None
+    def distance_km(self, from_branch, to_branch):
+        if branch_id(from_branch) == branch_id(to_branch):
+            return 0
 
-        return distance.distance_km
+        return self.matrix().distance_km(from_branch, to_branch)
 
     def transfer_time(self, from_branch, to_branch):
-        distance = self.get_queryset().distance(from_branch, to_branch)
-        if not distance:
-            return None
-
-        return datetime.timedelta(hours=distance.distance_km / self.CAR_SPEED)
+        return self.matrix().transfer_time(from_branch, to_branch)
 
 
 class CarQuerySet(models.QuerySet):
@@ -40,16 +51,187 @@ class CarQuerySet(models.QuerySet):
             reservation__end_time__gte=start_time,
         )
 
-    def with_current_branch(self, current_time):
+    def at_current_branch(self, current_time, expression, output_field):
+        """Build ``expression(branch_field)`` for each car's branch at ``current_time``.
+
+        Cars whose last scheduled transition happened before ``current_time``
+        read their materialized ``CarLocation``; the others read the
+        ``CarTransition`` stay covering ``current_time``. Only times before a
+        car's stored stays fall back to the latest ``CarBranchLog`` entry.
+        """
+        car_transition = self.model._meta.get_field("transitions").related_model
+        current_stay = (
+            car_transition.objects.filter(
+                models.Q(until__gte=current_time) | models.Q(until__isnull=True),
+                car=models.OuterRef("pk"),
+                timestamp__lt=current_time,
+            )
+            .annotate(value=expression("branch_id"))
+            .values("value")[:1]
+        )
+        car_branch_log = self.model._meta.get_field("carbranchlog").related_model
         latest_car_branch = (
-            self.filter(
-                carbranchlog__timestamp__lt=current_time,
-                carbranchlog__car=models.OuterRef("pk"),
+            car_branch_log.objects.filter(
+                car=models.OuterRef("pk"), timestamp__lt=current_time
+            )
+            .order_by("-timestamp")
+            .annotate(value=expression("branch_id"))
+            .values("value")[:1]
+        )
+        return models.Case(
+            models.When(
+                location__timestamp__lt=current_time,
+                then=expression("location__branch_id"),
+            ),
+            default=Coalesce(
+                models.Subquery(current_stay), models.Subquery(latest_car_branch)
+            ),
+            output_field=output_field,
+        )
+
+    def with_current_branch(self, current_time):
+        return self.annotate(
+            current_branch_id=self.at_current_branch(
+                current_time, models.F, models.BigIntegerField()
+            )
+        )
+
+    def _stays(self, current_time):
+        car_transition = self.model._meta.get_field("transitions").related_model
+        return car_transition.objects.filter(
+            models.Q(until__gte=current_time) | models.Q(until__isnull=True),
+            timestamp__lt=current_time,
+        )
+
+    def staying_at(self, current_time, branch_id):
+        """Filter the cars whose stored location or stay puts them at ``branch_id``.
+
+        Reads the same ``CarLocation`` and ``CarTransition`` rows as
+        ``at_current_branch`` through their branch indexes, so no per-car
+        expression is evaluated. Cars only placed by older ``CarBranchLog``
+        entries are left out, see ``without_stay``.
+        """
+        car_location = self.model._meta.get_field("location").related_model
+        located = car_location.objects.filter(
+            branch_id=branch_id, timestamp__lt=current_time
+        )
+        staying = self._stays(current_time).filter(branch_id=branch_id)
+        return self.filter(
+            models.Q(id__in=located.values("car_id"))
+            | (
+                models.Q(id__in=staying.values("car_id"))
+                & ~models.Q(location__timestamp__lt=current_time)
+            )
+        )
+
+    def without_stay(self, current_time):
+        """Filter the cars ``staying_at`` cannot place at ``current_time``.
+
+        These are cars without any branch log and, for times before their
+        stored stays, cars whose branch comes from the log itself.
+        """
+        return self.exclude(location__timestamp__lt=current_time).exclude(
+            id__in=self._stays(current_time).values("car_id")
+        )
+
+    def with_branch_rank(self, current_time, ranks):
+        """Annotate ``branch_rank`` from ``ranks`` keyed by current branch id."""
+
+        def rank(branch_field):
+            return models.Case(
+                *[
+                    models.When(**{branch_field: branch_id}, then=models.Value(rank))
+                    for branch_id, rank in ranks.items()
+                ],
+                default=models.Value(None),
+                output_field=models.IntegerField(),
             )
-            .order_by("-carbranchlog__timestamp")
-            .values("carbranchlog__branch_id")[:1]
+
+        return self.annotate(
+            branch_rank=self.at_current_branch(
+                current_time, rank, models.IntegerField()
+            )
+        )
+
+    def with_reservation_checks(self, start_time, end_time, previous_ok, next_ok):
+        """Alias whether the neighbouring reservations satisfy the given checks.
+
+        ``previous_ok`` is evaluated against the last reservation ending before
+        ``start_time`` and ``next_ok`` against the first one starting after
+        ``end_time``. Cars without such a reservation pass the check.
+        """
+        reservation = self.model._meta.get_field("reservation").related_model
+        previous_reservation = (
+            reservation.objects.filter(
+                car=models.OuterRef("pk"), end_time__lt=start_time
+            )
+            .order_by("-end_time")
+            .annotate(ok=_condition(previous_ok))
+            .values("ok")[:1]
+        )
+        next_reservation = (
+            reservation.objects.filter(
+                car=models.OuterRef("pk"), start_time__gt=end_time
+            )
+            .order_by("start_time")
+            .annotate(ok=_condition(next_ok))
+            .values("ok")[:1]
+        )
+        return self.alias(
+            previous_reservation_ok=Coalesce(
+                models.Subquery(previous_reservation), models.Value(True)
+            ),
+            next_reservation_ok=Coalesce(
+                models.Subquery(next_reservation), models.Value(True)
+            ),
         )
-        return self.annotate(current_branch_id=models.Subquery(latest_car_branch))
+
+
+class CarLocationManager(models.Manager):
+    def move(self, car, branch, timestamp):
+        """Record a transition unless the car already has a later one."""
+        updated = self.filter(car=car, timestamp__lte=timestamp).update(
+            branch=branch, timestamp=timestamp
+        )
+        if not updated:
+            self.get_or_create(
+                car=car, defaults={"branch": branch, "timestamp": timestamp}
+            )
+
+
+class CarTransitionManager(models.Manager):
+    def rebuild(self, car_ids, current_time=None):
+        """Rewrite the stays of ``car_ids`` from their ``CarBranchLog`` entries.
+
+        Keeps the stay current at ``current_time``, now by default, and every
+        later one, in three queries whatever the number of cars.
+        """
+        car_ids = list(car_ids)
+        current_time = current_time or now()
+        car = self.model._meta.get_field("car").related_model
+        car_branch_log = car._meta.get_field("carbranchlog").related_model
+        current_log = car_branch_log.objects.filter(
+            car_id=models.OuterRef("car_id"), timestamp__lte=current_time
+        ).order_by("-timestamp", "-id")[:1]
+        logs = (
+            car_branch_log.objects.filter(car_id__in=car_ids)
+            .filter(
+                models.Q(timestamp__gt=current_time)
+                | models.Q(id__in=models.Subquery(current_log.values("id")))
+            )
+            .order_by("car_id", "timestamp", "id")
+            .values_list("car_id", "branch_id", "timestamp")
+        )
+
+        transitions = []
+        for car_id, branch_id, timestamp in logs:
+            if transitions and transitions[-1].car_id == car_id:
+                transitions[-1].until = timestamp
+            transitions.append(
+                self.model(car_id=car_id, branch_id=branch_id, timestamp=timestamp)
+            )
+        self.filter(car_id__in=car_ids).delete()
+        self.bulk_create(transitions)
 
 
 class CarManager(models.Manager):
@@ -59,6 +241,15 @@ class CarManager(models.Manager):
     def reserved_cars(self, start_time, end_time):
         return self.get_queryset().reserved_cars(start_time, end_time)
 
+    def with_current_branch(self, current_time):
+        return self.get_queryset().with_current_branch(current_time)
+
+    def staying_at(self, current_time, branch_id):
+        return self.get_queryset().staying_at(current_time, branch_id)
+
+    def without_stay(self, current_time):
+        return self.get_queryset().without_stay(current_time)
+
     def available_cars(self, start_time, end_time, include_branch=True):
         reserved_cars = self.reserved_cars(start_time, end_time)
         return self.exclude(id__in=reserved_cars.values_list("id", flat=True))
@@ -74,7 +265,18 @@ class ReservationQuerySet(models.QuerySet):
     # def next_reservations(self, date_time):
     #    return self.filter(start_time__gt=date_time).order_by("-start_time")
 
+    def _can_distinct_on(self):
+        return connections[self.db].features.can_distinct_on_fields
+
     def next_reservations(self, date_time):
+        if self._can_distinct_on():
+            # PostgreSQL: one pass over the (car, start_time) index
+            return (
+                self.filter(start_time__gt=date_time)
+                .order_by("car_id", "start_time")
+                .distinct("car_id")
+            )
+
         next_reservation = self.filter(
             start_time__gt=date_time, car_id=models.OuterRef("car_id")
         ).order_by("start_time")[:1]
@@ -82,6 +284,13 @@ class ReservationQuerySet(models.QuerySet):
         return self.filter(id__in=models.Subquery(next_reservation.values("id")))
 
     def previous_reservations(self, date_time):
+        if self._can_distinct_on():
+            return (
+                self.filter(end_time__lt=date_time)
+                .order_by("car_id", "-end_time")
+                .distinct("car_id")
+            )
+
         previous_reservation = self.filter(
             end_time__lt=date_time, car_id=models.OuterRef("car_id")
         ).order_by("-end_time")[:1]
@@ -116,3 +325,19 @@ class ReservationManager(models.Manager):
 
     def previous_reservations(self, date_time):
         return self.get_queryset().previous_reservations(date_time)
+
+    def free_window(self, car_id, start_time, end_time):
+        """Return the stretch the car's reservations leave free around a window.
+
+        That is the end of its last reservation before ``start_time`` and the
+        start of its first one after ``end_time``, None where there is none.
+        Freeing the window changes the car's availability, and the branch it
+        is at, only within this stretch.
+        """
+        previous = models.Q(end_time__lt=start_time)
+        following = models.Q(start_time__gt=end_time)
+        window = self.filter(car_id=car_id).aggregate(
+            previous_end=models.Max("end_time", filter=previous),
+            next_start=models.Min("start_time", filter=following),
+        )
+        return window["previous_end"], window["next_start"]
@@ -0,0 +1,223 @@
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.utils.decorators import sync_and_async_middleware
+from cars.availability import availability_cache
+from cars.documents import document_cache
+from cars.instrumentation import OperationRecord, current_operation
+
+logger = logging.getLogger(__name__)
+
+
+class OperationMetrics:
+    """Process-wide totals of the recorded operations, by operation name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def observe(self, record, seconds):
+        with self._lock:
+            totals = self._operations.setdefault(
+                record.name,
+                {
+                    "count": 0,
+                    "seconds": 0.0,
+                    "queries": 0,
+                    "sql_seconds": 0.0,
+                    "resolvers": {},
+                    "sections": defaultdict(lambda: [0.0, 0]),
+                },
+            )
+            totals["count"] += 1
+            totals["seconds"] += seconds
+            totals["queries"] += record.queries
+            totals["sql_seconds"] += record.sql_seconds
+            if record.slowest_resolver is not None:
+                resolvers = totals["resolvers"]
+                resolvers[record.slowest_resolver] = max(
+                    resolvers.get(record.slowest_resolver, 0.0),
+                    record.slowest_resolver_seconds,
+                )
+            for name, (section_seconds, queries) in record.sections.items():
+                totals["sections"][name][0] += section_seconds
+                totals["sections"][name][1] += queries
+
+    def clear(self):
+        with self._lock:
+            self._operations.clear()
+
+    def render(self):
+        """Return the totals and cache statistics in Prometheus text format."""
+        with self._lock:
+            operations = {
+                name: {
+                    **totals,
+                    "resolvers": dict(totals["resolvers"]),
+                    "sections": {
+                        section_name: list(values)
+                        for section_name, values in totals["sections"].items()
+                    },
+                }
+                for name, totals in self._operations.items()
+            }
+
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                lines.append(f"{name}{suffix}{format_labels(labels)} {value}")
+
+        metric(
+            "cars_graphql_operation_seconds",
+            "summary",
+            "Wall time of GraphQL requests.",
+            [
+                sample
+                for name, totals in operations.items()
+                for sample in (
+                    ("_count", {"operation": name}, totals["count"]),
+                    ("_sum", {"operation": name}, totals["seconds"]),
+                )
+            ],
+        )
+        metric(
+            "cars_graphql_sql_queries_total",
+            "counter",
+            "SQL queries run by GraphQL requests.",
+            [
+                ("", {"operation": name}, totals["queries"])
+                for name, totals in operations.items()
+            ],
+        )
+        metric(
+            "cars_graphql_sql_seconds_total",
+            "counter",
+            "Time spent in SQL queries by GraphQL requests.",
+            [
+                ("", {"operation": name}, totals["sql_seconds"])
+                for name, totals in operations.items()
+            ],
+        )
+        metric(
+            "cars_graphql_slowest_resolver_seconds",
+            "gauge",
+            "Longest time of a resolver that was the slowest of its request.",
+            [
+                ("", {"operation": name, "resolver": resolver}, seconds)
+                for name, totals in operations.items()
+                for resolver, seconds in totals["resolvers"].items()
+            ],
+        )
+        metric(
+            "cars_graphql_section_seconds_total",
+            "counter",
+            "Time spent in the search, distance and insert sections.",
+            [
+                ("", {"operation": name, "section": section_name}, values[0])
+                for name, totals in operations.items()
+                for section_name, values in totals["sections"].items()
+            ],
+        )
+        metric(
+            "cars_graphql_section_queries_total",
+            "counter",
+            "SQL queries run in the search, distance and insert sections.",
+            [
+                ("", {"operation": name, "section": section_name}, values[1])
+                for name, totals in operations.items()
+                for section_name, values in totals["sections"].items()
+            ],
+        )
+
+        for cache_name, cache in (
+            ("document", document_cache),
+            ("availability", availability_cache),
+        ):
+            stats = cache.stats()
+            metric(
+                f"cars_{cache_name}_cache_size",
+                "gauge",
+                f"Entries in the {cache_name} cache.",
+                [("", {}, stats["size"])],
+            )
+            for field in ("hits", "misses"):
+                metric(
+                    f"cars_{cache_name}_cache_{field}_total",
+                    "counter",
+                    f"Lookups of the {cache_name} cache that were {field}.",
+                    [("", {}, stats[field])],
+                )
+
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n"))
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+operation_metrics = OperationMetrics()
+
+
+def finish(record, seconds):
+    if not record.names:
+        # not a GraphQL operation, or answered without resolving any field
+        return
+
+    operation_metrics.observe(record, seconds)
+    if settings.CARS_METRICS_LOG:
+        logger.info(json.dumps(record.as_dict(seconds)))
+
+
+@sync_and_async_middleware
+def operation_metrics_middleware(get_response):
+    """Record the operations served by a request when ``CARS_METRICS`` is set.
+
+    The record is kept in ``current_operation``, which ``record_query`` and
+    ``ResolverTimingMiddleware`` fill in, including from the threads
+    ``sync_to_async`` runs resolvers in.
+    """
+    if iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            if not settings.CARS_METRICS:
+                return await get_response(request)
+
+            record = OperationRecord()
+            token = current_operation.set(record)
+            started = time.perf_counter()
+            try:
+                return await get_response(request)
+            finally:
+                current_operation.reset(token)
+                finish(record, time.perf_counter() - started)
+
+    else:
+
+        def middleware(request):
+            if not settings.CARS_METRICS:
+                return get_response(request)
+
+            record = OperationRecord()
+            token = current_operation.set(record)
+            started = time.perf_counter()
+            try:
+                return get_response(request)
+            finally:
+                current_operation.reset(token)
+                finish(record, time.perf_counter() - started)
+
+    return middleware
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.5 on 2026-10-17 17:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cars', '0003_remove_car_branch_carbranchlog'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='branch',
+            name='city',
+            field=models.CharField(max_length=100, unique=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='carbranchlog',
+            unique_together={('car', 'branch', 'timestamp')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='distance',
+            unique_together={('from_branch', 'to_branch')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='reservation',
+            unique_together={('car', 'start_time', 'end_time')},
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['car', 'start_time'], name='cars_res_car_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['car', 'end_time', 'start_time'], name='cars_res_car_end_idx'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.5 on 2026-10-17 17:56
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_car_locations(apps, schema_editor):
+    CarBranchLog = apps.get_model("cars", "CarBranchLog")
+    CarLocation = apps.get_model("cars", "CarLocation")
+
+    locations = {}
+    for car_id, branch_id, timestamp in CarBranchLog.objects.order_by(
+        "timestamp"
+    ).values_list("car_id", "branch_id", "timestamp"):
+        locations[car_id] = CarLocation(
+            car_id=car_id, branch_id=branch_id, timestamp=timestamp
+        )
+
+    CarLocation.objects.bulk_create(locations.values())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cars', '0004_reservation_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CarLocation',
+            fields=[
+                ('car', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='location', serialize=False, to='cars.car')),
+                ('timestamp', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='carbranchlog',
+            index=models.Index(fields=['car', 'timestamp', 'branch'], name='cars_log_car_time_idx'),
+        ),
+        migrations.AddField(
+            model_name='carlocation',
+            name='branch',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cars.branch'),
+        ),
+        migrations.RunPython(create_car_locations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,73 @@
+from django.db import migrations
+
+CREATE_SQL = {
+    "postgresql": [
+        # car_id is compared as a one-value range, so the constraint needs no
+        # btree_gist extension (often unavailable on hosted PostgreSQL)
+        """
+        ALTER TABLE cars_reservation ADD CONSTRAINT cars_reservation_no_overlap
+        EXCLUDE USING gist (
+            int8range(car_id, car_id, '[]') WITH =,
+            tstzrange(start_time, end_time, '[]') WITH &&
+        )
+        """,
+    ],
+    "sqlite": [
+        """
+        CREATE TRIGGER cars_reservation_no_overlap_insert
+        BEFORE INSERT ON cars_reservation
+        WHEN EXISTS (
+            SELECT 1 FROM cars_reservation
+            WHERE car_id = NEW.car_id
+            AND start_time <= NEW.end_time
+            AND end_time >= NEW.start_time
+        )
+        BEGIN
+            SELECT RAISE(ABORT, 'cars_reservation_no_overlap');
+        END
+        """,
+        """
+        CREATE TRIGGER cars_reservation_no_overlap_update
+        BEFORE UPDATE OF car_id, start_time, end_time ON cars_reservation
+        WHEN EXISTS (
+            SELECT 1 FROM cars_reservation
+            WHERE car_id = NEW.car_id
+            AND start_time <= NEW.end_time
+            AND end_time >= NEW.start_time
+            AND id != NEW.id
+        )
+        BEGIN
+            SELECT RAISE(ABORT, 'cars_reservation_no_overlap');
+        END
+        """,
+    ],
+}
+
+DROP_SQL = {
+    "postgresql": [
+        "ALTER TABLE cars_reservation DROP CONSTRAINT cars_reservation_no_overlap",
+    ],
+    "sqlite": [
+        "DROP TRIGGER cars_reservation_no_overlap_insert",
+        "DROP TRIGGER cars_reservation_no_overlap_update",
+    ],
+}
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cars', '0005_carlocation'),
+    ]
+
+    operations = [
+        migrations.RunPython(run(CREATE_SQL), run(DROP_SQL)),
+    ]
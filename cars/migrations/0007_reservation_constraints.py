@@ -0,0 +1,33 @@
+import importlib
+
+from django.db import migrations, models
+
+no_overlap = importlib.import_module("cars.migrations.0006_reservation_no_overlap")
+
+
+def create_sqlite_triggers(apps, schema_editor):
+    # SQLite rebuilds the table to add or remove the unique constraint, which
+    # drops the overlap triggers of 0006
+    if schema_editor.connection.vendor == "sqlite":
+        for statement in no_overlap.CREATE_SQL["sqlite"]:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cars', '0006_reservation_no_overlap'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, create_sqlite_triggers),
+        migrations.AlterUniqueTogether(
+            name='reservation',
+            unique_together=set(),
+        ),
+        migrations.AddConstraint(
+            model_name='reservation',
+            constraint=models.UniqueConstraint(fields=('car', 'start_time', 'end_time'), name='cars_reservation_unique_window'),
+        ),
+        migrations.RunPython(create_sqlite_triggers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 4.2.5 on 2026-10-17 19:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.utils.timezone import now
+
+
+def create_car_transitions(apps, schema_editor):
+    CarBranchLog = apps.get_model("cars", "CarBranchLog")
+    CarTransition = apps.get_model("cars", "CarTransition")
+
+    current_time = now()
+    stays = {}
+    for car_id, branch_id, timestamp in CarBranchLog.objects.order_by(
+        "car_id", "timestamp", "id"
+    ).values_list("car_id", "branch_id", "timestamp"):
+        car_stays = stays.setdefault(car_id, [])
+        if car_stays:
+            car_stays[-1].until = timestamp
+            if timestamp <= current_time:
+                # only the stay current now and the later ones are kept
+                car_stays.pop()
+        car_stays.append(
+            CarTransition(car_id=car_id, branch_id=branch_id, timestamp=timestamp)
+        )
+
+    CarTransition.objects.bulk_create(
+        stay for car_stays in stays.values() for stay in car_stays
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("cars", "0007_reservation_constraints"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CarTransition",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("timestamp", models.DateTimeField()),
+                ("until", models.DateTimeField(null=True)),
+                (
+                    "branch",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="cars.branch"
+                    ),
+                ),
+                (
+                    "car",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="transitions",
+                        to="cars.car",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["car", "timestamp"], name="cars_transition_car_time_idx"
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(create_car_transitions, migrations.RunPython.noop),
+    ]
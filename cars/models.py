@@ -1,7 +1,13 @@
-from django.db import models
 from django.core.validators import RegexValidator
 from django.core.exceptions import ValidationError
-from cars.managers import DistanceManager, CarManager, ReservationManager
+from django.db import models, transaction
+from cars.managers import (
+    DistanceManager,
+    CarManager,
+    CarLocationManager,
+    CarTransitionManager,
+    ReservationManager,
+)
 
 
 class CarNumberField(models.CharField):
@@ -78,8 +84,59 @@ class CarBranchLog(models.Model):
     def __str__(self):
         return f"{self.car} {self.branch} {self.timestamp}"
 
+    @transaction.atomic
+    def save(self, *args, **kwargs):
+        super(CarBranchLog, self).save(*args, **kwargs)
+        CarLocation.objects.move(self.car, self.branch, self.timestamp)
+        CarTransition.objects.rebuild([self.car_id])
+
     class Meta:
         unique_together = ("car", "branch", "timestamp")
+        indexes = [
+            models.Index(
+                fields=["car", "timestamp", "branch"], name="cars_log_car_time_idx"
+            ),
+        ]
+
+
+class CarLocation(models.Model):
+    """Branch a car ends up at after its last scheduled ``CarBranchLog`` entry."""
+
+    car = models.OneToOneField(
+        Car, on_delete=models.CASCADE, primary_key=True, related_name="location"
+    )
+    branch = models.ForeignKey(Branch, on_delete=models.CASCADE)
+    timestamp = models.DateTimeField()
+
+    objects = CarLocationManager()
+
+    def __str__(self):
+        return f"{self.car} {self.branch} {self.timestamp}"
+
+
+class CarTransition(models.Model):
+    """A car's stay at ``branch`` from ``timestamp`` until the next transition.
+
+    Each car keeps the stay current when its log last changed and every
+    scheduled stay after it. ``until`` is None for the last stay.
+    """
+
+    car = models.ForeignKey(Car, on_delete=models.CASCADE, related_name="transitions")
+    branch = models.ForeignKey(Branch, on_delete=models.CASCADE)
+    timestamp = models.DateTimeField()
+    until = models.DateTimeField(null=True)
+
+    objects = CarTransitionManager()
+
+    def __str__(self):
+        return f"{self.car} {self.branch} {self.timestamp}-{self.until}"
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["car", "timestamp"], name="cars_transition_car_time_idx"
+            ),
+        ]
 
 
 class Reservation(models.Model):
@@ -95,6 +152,7 @@ class Reservation(models.Model):
 
     objects = ReservationManager()
 
+    @transaction.atomic
     def save(self, *args, **kwargs):
         super(Reservation, self).save(*args, **kwargs)
 
@@ -110,4 +168,15 @@ class Reservation(models.Model):
         return f"{self.car} {self.start_time} {self.end_time} {self.pickup_branch} {self.return_branch}"
 
     class Meta:
-        unique_together = ("car", "start_time", "end_time")
+        constraints = [
+            models.UniqueConstraint(
+                fields=["car", "start_time", "end_time"],
+                name="cars_reservation_unique_window",
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["car", "start_time"], name="cars_res_car_start_idx"),
+            models.Index(
+                fields=["car", "end_time", "start_time"], name="cars_res_car_end_idx"
+            ),
+        ]
@@ -0,0 +1,88 @@
+import base64
+import json
+
+from django.conf import settings
+from django.db.models import Q
+from graphene import relay
+from graphql import GraphQLError
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise GraphQLError("Invalid cursor.")
+
+
+def page_size(first):
+    max_page_size = settings.CARS_MAX_PAGE_SIZE
+    if first is None:
+        return max_page_size
+    if first < 0:
+        raise GraphQLError("first must be a non-negative number.")
+    return min(first, max_page_size)
+
+
+def cursor_values(instance, ordering):
+    values = []
+    for name in ordering:
+        value = getattr(instance, name)
+        values.append(value.isoformat() if hasattr(value, "isoformat") else value)
+    return values
+
+
+def after_cursor(model, ordering, cursor):
+    """Build the keyset condition for rows sorted after ``cursor``."""
+    values = decode_cursor(cursor)
+    if not isinstance(values, list) or len(values) != len(ordering):
+        raise GraphQLError("Invalid cursor.")
+
+    try:
+        values = [
+            model._meta.get_field(name).to_python(value)
+            for name, value in zip(ordering, values)
+        ]
+    except Exception:
+        raise GraphQLError("Invalid cursor.")
+
+    condition = Q()
+    for index, name in enumerate(ordering):
+        equal = dict(zip(ordering[:index], values[:index]))
+        condition |= Q(**equal, **{f"{name}__gt": values[index]})
+    return condition
+
+
+def paginate(connection_type, queryset, ordering, first=None, after=None):
+    """Return one page of ``queryset`` as ``connection_type``.
+
+    Rows are sorted ascending by ``ordering``, which must identify a row
+    uniquely, and ``after`` continues from the cursor of a previous page, so
+    every page is a bounded index range scan regardless of its position.
+    """
+    queryset = queryset.order_by(*ordering)
+    if after is not None:
+        queryset = queryset.filter(after_cursor(queryset.model, ordering, after))
+
+    limit = page_size(first)
+    items = list(queryset[: limit + 1])
+    has_next_page = len(items) > limit
+
+    edges = [
+        connection_type.Edge(
+            node=item, cursor=encode_cursor(cursor_values(item, ordering))
+        )
+        for item in items[:limit]
+    ]
+    return connection_type(
+        edges=edges,
+        page_info=relay.PageInfo(
+            has_next_page=has_next_page,
+            has_previous_page=after is not None,
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None,
+        ),
+    )
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from graphql import FieldNode, OperationType, get_operation_ast, print_ast
+
+# Read fields of Query whose responses may be cached, with the models they
+# are built from and whether they depend on the current time.
+CACHED_FIELDS = {
+    "allCars": (("cars.car", "cars.carbranchlog"), False),
+    "car": (("cars.car", "cars.carbranchlog"), False),
+    "allCarsConnection": (("cars.car", "cars.carbranchlog"), False),
+    "upcomingReservations": (
+        ("cars.reservation", "cars.car", "cars.branch"),
+        True,
+    ),
+    "upcomingReservationsConnection": (
+        ("cars.reservation", "cars.car", "cars.branch"),
+        True,
+    ),
+}
+
+
+def get_cache():
+    return caches[settings.CARS_RESPONSE_CACHE_ALIAS]
+
+
+def version_key(label):
+    return f"cars:response-version:{label}"
+
+
+def invalidate(*labels):
+    """Expire the cached responses built from the models ``labels``."""
+    cache = get_cache()
+    for label in labels:
+        try:
+            cache.incr(version_key(label))
+        except ValueError:
+            # evicted or never set: any fresh value differs from the old one
+            cache.set(version_key(label), time.time_ns(), None)
+
+
+def cache_policy(document, operation_name):
+    """Return the models and timeout of a cacheable operation, else None."""
+    operation = get_operation_ast(document, operation_name)
+    if operation is None or operation.operation != OperationType.QUERY:
+        return None
+
+    labels = set()
+    timeout = settings.CARS_RESPONSE_CACHE_TIMEOUT
+    for node in operation.selection_set.selections:
+        if not isinstance(node, FieldNode):
+            return None
+        if node.name.value == "__typename":
+            continue
+        if node.name.value not in CACHED_FIELDS:
+            return None
+
+        models, uses_now = CACHED_FIELDS[node.name.value]
+        labels.update(models)
+        if uses_now:
+            timeout = min(timeout, settings.CARS_RESPONSE_CACHE_UPCOMING_TIMEOUT)
+
+    if not labels:
+        return None
+    return sorted(labels), timeout
+
+
+async def cache_key(labels, document, operation_name, variables):
+    """Key a response by the versions of its models, the query and variables."""
+    cache = get_cache()
+    keys = [version_key(label) for label in labels]
+    versions = await cache.aget_many(keys)
+    for key in keys:
+        if key not in versions:
+            await cache.aadd(key, time.time_ns(), None)
+            versions[key] = await cache.aget(key)
+
+    request = json.dumps(
+        [
+            print_ast(document),
+            operation_name,
+            variables or {},
+            [versions[key] for key in keys],
+        ],
+        sort_keys=True,
+        default=str,
+    )
+    return "cars:response:" + hashlib.sha256(request.encode()).hexdigest()
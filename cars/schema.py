@@ -1,10 +1,17 @@
 import graphene
+from graphene import relay
 from graphene_django import DjangoObjectType
 from django.utils.timezone import now
 from cars.models import Branch, Car, Reservation, CarBranchLog, Distance
-from cars.utils import total_minutes
-from cars.car_search import reserve_car, reserve_cars
+from cars.utils import maybe_async, total_minutes
+from cars.allocation import reserve_cars
+from cars.car_search import reserve_car, search_available_cars
+from cars.loaders import get_loaders
+from cars.pagination import page_size, paginate
+from cars.selection import fetch, plan_queryset, selected_fields
 import datetime
+import itertools
+from django.db import transaction
 from graphql import GraphQLError
 
 
@@ -35,6 +42,11 @@ class CarType(DjangoObjectType):
     #    )
 
 
+class CarConnection(relay.Connection):
+    class Meta:
+        node = CarType
+
+
 class CreateCarInput(graphene.InputObjectType):
     car_number = graphene.String(required=True)
     make = graphene.String(required=True)
@@ -56,6 +68,8 @@ class CreateCar(graphene.Mutation):
     car_branch_log = graphene.Field(CarBranchLogType)
 
     @staticmethod
+    @maybe_async
+    @transaction.atomic
     def mutate(root, info, car_data):
         branch = Branch.objects.get(city=car_data.branch.city)
         car = Car.objects.create(
@@ -74,6 +88,7 @@ class DeleteCar(graphene.Mutation):
     ok = graphene.Boolean()
 
     @staticmethod
+    @maybe_async
     def mutate(root, info, car_number):
         car = Car.objects.get(car_number=car_number)
 
@@ -98,6 +113,7 @@ class UpdateCar(graphene.Mutation):
     car = graphene.Field(CarType)
 
     @staticmethod
+    @maybe_async
     def mutate(root, info, car_data):
         car = Car.objects.get(car_number=car_data.car_number)
 
@@ -122,6 +138,28 @@ class ReservationType(DjangoObjectType):
             "return_branch",
         ]
 
+    # the list resolvers join the requested relations; the loaders batch
+    # the lookups of reservations that arrive without them
+    def resolve_car(self, info):
+        if Reservation.car.is_cached(self):
+            return self.car
+        return get_loaders(info).car.load(self.car_id)
+
+    def resolve_pickup_branch(self, info):
+        if Reservation.pickup_branch.is_cached(self):
+            return self.pickup_branch
+        return get_loaders(info).branch.load(self.pickup_branch_id)
+
+    def resolve_return_branch(self, info):
+        if Reservation.return_branch.is_cached(self):
+            return self.return_branch
+        return get_loaders(info).branch.load(self.return_branch_id)
+
+
+class ReservationConnection(relay.Connection):
+    class Meta:
+        node = ReservationType
+
 
 class ReservationInput(graphene.InputObjectType):
     start_time = graphene.DateTime(required=True)
@@ -130,13 +168,13 @@ class ReservationInput(graphene.InputObjectType):
     return_branch = BranchInput(required=True)
 
 
-def validate_reservation(reservation_data):
-    pickup_branch = Branch.objects.get(city=reservation_data.pickup_branch.city)
-    return_branch = Branch.objects.get(city=reservation_data.return_branch.city)
-    duration_time = datetime.timedelta(minutes=reservation_data.duration_minutes)
-    end_time = reservation_data.start_time + duration_time
+def validate_reservation(start_time, duration_minutes, pickup_branch, return_branch):
+    pickup_branch = Branch.objects.get(city=pickup_branch.city)
+    return_branch = Branch.objects.get(city=return_branch.city)
+    duration_time = datetime.timedelta(minutes=duration_minutes)
+    end_time = start_time + duration_time
 
-    if reservation_data.start_time < now():
+    if start_time < now():
         raise GraphQLError("Start time must be in the future.")
     if not pickup_branch or not return_branch:
         raise GraphQLError("Invalid branch.")
@@ -149,7 +187,7 @@ def validate_reservation(reservation_data):
             f"Can't reach the branch: {return_branch} in time. Required transfer time: {total_minutes(required_transfer_time)} minutes."
         )
 
-    return reservation_data.start_time, end_time, pickup_branch, return_branch
+    return start_time, end_time, pickup_branch, return_branch
 
 
 class CreateReservation(graphene.Mutation):
@@ -159,9 +197,10 @@ class CreateReservation(graphene.Mutation):
     reservation = graphene.Field(ReservationType)
 
     @classmethod
+    @maybe_async
     def mutate(cls, root, info, reservation_data):
         start_time, end_time, pickup_branch, return_branch = validate_reservation(
-            reservation_data
+            **reservation_data
         )
 
         reservation = reserve_car(
@@ -184,12 +223,13 @@ class CreateReservations(graphene.Mutation):
     reservations = graphene.List(ReservationType)
 
     @classmethod
+    @maybe_async
     def mutate(cls, root, info, reservations_data):
         reservations = []
 
         reservation_list = []
         for reservation_data in reservations_data:
-            reservation_list.append(validate_reservation(reservation_data))
+            reservation_list.append(validate_reservation(**reservation_data))
 
         reservations = reserve_cars(reservation_list)
 
@@ -211,15 +251,62 @@ class Query(graphene.ObjectType):
     all_cars = graphene.List(CarType)
     car = graphene.Field(CarType, car_id=graphene.String(required=True))
     upcoming_reservations = graphene.List(ReservationType)
+    available_cars = graphene.List(
+        CarType,
+        start_time=graphene.DateTime(required=True),
+        duration_minutes=graphene.Int(required=True),
+        pickup_branch=BranchInput(required=True),
+        return_branch=BranchInput(required=True),
+        first=graphene.Int(),
+    )
+    all_cars_connection = graphene.Field(
+        CarConnection, first=graphene.Int(), after=graphene.String()
+    )
+    upcoming_reservations_connection = graphene.Field(
+        ReservationConnection, first=graphene.Int(), after=graphene.String()
+    )
 
+    @maybe_async
     def resolve_all_cars(self, info, **kwargs):
-        return Car.objects.all()
+        return fetch(plan_queryset(Car.objects.all(), selected_fields(info)))
 
+    @maybe_async
     def resolve_car(self, info, car_number):
         return Car.objects.get(car_number=car_number)
 
+    @maybe_async
     def resolve_upcoming_reservations(self, info):
-        return Reservation.objects.upcoming()
+        return fetch(
+            plan_queryset(Reservation.objects.upcoming(), selected_fields(info))
+        )
+
+    @maybe_async
+    def resolve_available_cars(self, info, first=None, **reservation_data):
+        search = search_available_cars(*validate_reservation(**reservation_data))
+        return list(itertools.islice(search, page_size(first)))
+
+    @maybe_async
+    def resolve_all_cars_connection(self, info, first=None, after=None):
+        selection = selected_fields(info).get("edges", {}).get("node", {})
+        return paginate(
+            CarConnection,
+            plan_queryset(Car.objects.all(), selection),
+            ("id",),
+            first,
+            after,
+        )
+
+    @maybe_async
+    def resolve_upcoming_reservations_connection(self, info, first=None, after=None):
+        selection = selected_fields(info).get("edges", {}).get("node", {})
+        ordering = ("start_time", "id")
+        return paginate(
+            ReservationConnection,
+            plan_queryset(Reservation.objects.upcoming(), selection, ordering),
+            ordering,
+            first,
+            after,
+        )
 
 
 schema = graphene.Schema(query=Query, mutation=Mutation)
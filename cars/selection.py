@@ -0,0 +1,78 @@
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from graphene.utils.str_converters import to_snake_case
+from graphql.language import FieldNode, FragmentSpreadNode, InlineFragmentNode
+
+
+def selected_fields(info, field_nodes=None):
+    """Return the fields requested below the resolved field as a nested dict.
+
+    Keys are snake_case field names and values are their own selections,
+    empty for scalars. Fragments are merged into the selection.
+    """
+    selection = {}
+    for field_node in field_nodes or info.field_nodes:
+        _collect(info, field_node.selection_set, selection)
+    return selection
+
+
+def _collect(info, selection_set, selection):
+    if selection_set is None:
+        return
+
+    for node in selection_set.selections:
+        if isinstance(node, FieldNode):
+            name = to_snake_case(node.name.value)
+            if not name.startswith("__"):
+                _collect(info, node.selection_set, selection.setdefault(name, {}))
+        elif isinstance(node, FragmentSpreadNode):
+            _collect(info, info.fragments[node.name.value].selection_set, selection)
+        elif isinstance(node, InlineFragmentNode):
+            _collect(info, node.selection_set, selection)
+
+
+def _columns(model, selection, prefix=""):
+    columns = {prefix + model._meta.pk.name}
+    related = []
+
+    for name, children in selection.items():
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            continue
+
+        if field.many_to_one:
+            related.append(prefix + name)
+            nested_columns, nested_related = _columns(
+                field.related_model, children, f"{prefix}{name}__"
+            )
+            columns |= nested_columns
+            related += nested_related
+        elif field.concrete and not field.is_relation:
+            columns.add(prefix + name)
+
+    return columns, related
+
+
+def plan_queryset(queryset, selection, required=()):
+    """Restrict ``queryset`` to the columns and joins ``selection`` asks for.
+
+    Requested foreign keys are joined with ``select_related`` and every model
+    only loads its primary key, the requested concrete fields and the
+    ``required`` ones the resolver itself reads.
+    """
+    columns, related = _columns(queryset.model, selection)
+    if related:
+        queryset = queryset.select_related(*related)
+    return queryset.only(*columns, *required)
+
+
+def fetch(queryset, chunk_size=2000):
+    """Return the rows of a list resolver, streamed if configured.
+
+    With ``CARS_SERVER_SIDE_CURSORS`` the rows are read ``chunk_size`` at a
+    time (from a server-side cursor on PostgreSQL) rather than all at once.
+    """
+    if settings.CARS_SERVER_SIDE_CURSORS:
+        return queryset.iterator(chunk_size=chunk_size)
+    return queryset
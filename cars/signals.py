@@ -0,0 +1,210 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.db import transaction
+from django.dispatch import Signal, receiver
+from cars import responses
+from cars.availability import availability_cache
+from cars.distances import distance_cache
+from cars.fleet import fleet_timeline
+from cars.instrumentation import install_query_recorder
+from cars.models import (
+    Branch,
+    Car,
+    CarBranchLog,
+    CarLocation,
+    CarTransition,
+    Distance,
+    Reservation,
+)
+
+# Sent by cars.bulk.bulk_reserve with the created ``reservations`` and their
+# ``car_branch_logs``.
+reservations_bulk_created = Signal()
+
+
+@receiver(post_save, sender=Distance)
+def update_distance_cache(sender, instance, created, raw, **kwargs):
+    if raw:
+        # fixture rows may arrive before their branches, so rebuild instead
+        transaction.on_commit(clear_caches)
+        return
+
+    key = (instance.from_branch_id, instance.to_branch_id)
+    distance_km = instance.distance_km
+
+    def change(table):
+        # an update that is not in the table may have moved the row's branches
+        if not created and key not in table.direct:
+            return None
+        return table.with_distance(*key, distance_km)
+
+    def update():
+        distance_cache.update(change)
+        availability_cache.clear()
+
+    # after commit, so a rolled back route never reaches the shared table
+    transaction.on_commit(update)
+
+
+@receiver(post_delete, sender=Distance)
+@receiver(post_save, sender=Branch)
+@receiver(post_delete, sender=Branch)
+def clear_distance_cache(sender, **kwargs):
+    clear_caches()
+    # a table reloaded inside the transaction may hold its uncommitted rows
+    transaction.on_commit(clear_caches)
+
+
+def clear_caches():
+    distance_cache.clear()
+    # transfer times decide availability
+    availability_cache.clear()
+
+
+def drop_freed_window(car_id, start_time, end_time):
+    # the car may now be free anywhere between its neighbouring reservations
+    window = Reservation.objects.free_window(car_id, start_time, end_time)
+    transaction.on_commit(lambda: availability_cache.drop_overlapping(*window))
+
+
+@receiver(pre_save, sender=Reservation)
+def remember_reserved_window(sender, instance, raw, **kwargs):
+    if settings.CARS_AVAILABILITY_CACHE and not raw and instance.pk is not None:
+        instance._reserved_window = (
+            Reservation.objects.filter(pk=instance.pk)
+            .values_list("car_id", "start_time", "end_time")
+            .first()
+        )
+
+
+@receiver(post_save, sender=Reservation)
+def remove_reserved_car(sender, instance, created, **kwargs):
+    if settings.CARS_AVAILABILITY_CACHE:
+        car_ids = [instance.car_id]
+        transaction.on_commit(lambda: availability_cache.remove_cars(car_ids))
+
+        # a rescheduled reservation frees its old window
+        reserved_window = getattr(instance, "_reserved_window", None)
+        if not created and reserved_window not in (
+            None,
+            (instance.car_id, instance.start_time, instance.end_time),
+        ):
+            drop_freed_window(*reserved_window)
+
+
+@receiver(reservations_bulk_created)
+def remove_bulk_reserved_cars(sender, reservations, **kwargs):
+    if settings.CARS_AVAILABILITY_CACHE:
+        car_ids = {reservation.car_id for reservation in reservations}
+        transaction.on_commit(lambda: availability_cache.remove_cars(car_ids))
+
+
+@receiver(post_delete, sender=Reservation)
+def drop_freed_availability(sender, instance, **kwargs):
+    if settings.CARS_AVAILABILITY_CACHE:
+        drop_freed_window(instance.car_id, instance.start_time, instance.end_time)
+
+
+@receiver(post_delete, sender=CarBranchLog)
+def refresh_car_location(sender, instance, **kwargs):
+    CarTransition.objects.rebuild([instance.car_id])
+    latest = (
+        CarBranchLog.objects.filter(car_id=instance.car_id)
+        .order_by("-timestamp")
+        .first()
+    )
+    if latest is None:
+        CarLocation.objects.filter(car_id=instance.car_id).delete()
+        return
+
+    CarLocation.objects.update_or_create(
+        car_id=instance.car_id,
+        defaults={"branch_id": latest.branch_id, "timestamp": latest.timestamp},
+    )
+
+
+@receiver(post_save, sender=Car)
+@receiver(post_delete, sender=Car)
+@receiver(post_save, sender=Reservation)
+@receiver(post_delete, sender=Reservation)
+@receiver(post_save, sender=CarBranchLog)
+@receiver(post_delete, sender=CarBranchLog)
+@receiver(post_save, sender=Branch)
+@receiver(post_delete, sender=Branch)
+def invalidate_responses(sender, **kwargs):
+    if not settings.CARS_RESPONSE_CACHE:
+        return
+
+    # after commit, so no request caches the old rows under the new version
+    label = sender._meta.label_lower
+    transaction.on_commit(lambda: responses.invalidate(label))
+
+
+@receiver(reservations_bulk_created)
+def invalidate_bulk_responses(sender, **kwargs):
+    if not settings.CARS_RESPONSE_CACHE:
+        return
+
+    labels = (Reservation._meta.label_lower, CarBranchLog._meta.label_lower)
+    transaction.on_commit(lambda: responses.invalidate(*labels))
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+
+    with connection.cursor() as cursor:
+        for name, value in settings.CARS_SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+
+
+@receiver(connection_created)
+def record_queries(sender, connection, **kwargs):
+    install_query_recorder(connection)
+
+
+@receiver(post_save, sender=Car)
+def save_timeline_car(sender, instance, **kwargs):
+    transaction.on_commit(lambda: fleet_timeline.save_car(instance))
+
+
+@receiver(post_delete, sender=Car)
+def delete_timeline_car(sender, instance, **kwargs):
+    car_id = instance.id
+    transaction.on_commit(lambda: fleet_timeline.delete_car(car_id))
+
+
+@receiver(post_save, sender=Reservation)
+def save_timeline_reservation(sender, instance, **kwargs):
+    transaction.on_commit(lambda: fleet_timeline.save_reservation(instance))
+
+
+@receiver(post_delete, sender=Reservation)
+def delete_timeline_reservation(sender, instance, **kwargs):
+    # delete() clears the instance's id before the transaction commits
+    reservation_id = instance.id
+    transaction.on_commit(lambda: fleet_timeline.delete_reservation(reservation_id))
+
+
+@receiver(reservations_bulk_created)
+def save_timeline_bulk_reservations(sender, reservations, car_branch_logs, **kwargs):
+    def save():
+        for reservation in reservations:
+            fleet_timeline.save_reservation(reservation)
+        for log in car_branch_logs:
+            fleet_timeline.save_log(log)
+
+    transaction.on_commit(save)
+
+
+@receiver(post_save, sender=CarBranchLog)
+def save_timeline_log(sender, instance, **kwargs):
+    transaction.on_commit(lambda: fleet_timeline.save_log(instance))
+
+
+@receiver(post_delete, sender=CarBranchLog)
+def delete_timeline_log(sender, instance, **kwargs):
+    log_id = instance.id
+    transaction.on_commit(lambda: fleet_timeline.delete_log(log_id))
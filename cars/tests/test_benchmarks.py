@@ -0,0 +1,55 @@
+import json
+import os
+import tempfile
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+from cars.benchmarks import percentile_ms
+from cars.models import Car, Reservation
+
+
+class BenchmarkFleetTestCase(TestCase):
+    def test_percentile(self):
+        durations = [0.001 * number for number in range(1, 101)]
+        self.assertAlmostEqual(50, percentile_ms(durations, 50))
+        self.assertAlmostEqual(99, percentile_ms(durations, 99))
+        self.assertAlmostEqual(5, percentile_ms([0.005], 99))
+
+    def test_benchmark_fleet(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "fleet.json")
+            call_command(
+                "benchmark_fleet",
+                branches=3,
+                cars=5,
+                history=20,
+                upcoming=10,
+                batch=2,
+                repeat=2,
+                output=output,
+                stdout=StringIO(),
+            )
+            with open(output) as file:
+                report = json.load(file)
+
+        self.assertEqual(
+            {
+                "search_python",
+                "search_sql",
+                "search_lazy",
+                "search_memory",
+                "first_car_python",
+                "first_car_sql",
+                "first_car_lazy",
+                "first_car_memory",
+                "with_current_branch",
+                "reserve_car",
+                "reserve_cars",
+                "all_cars",
+                "upcoming_reservations",
+            },
+            set(report["results"]),
+        )
+        self.assertEqual(1, report["results"]["all_cars"]["queries"])
+        self.assertFalse(Car.objects.exists() or Reservation.objects.exists())
@@ -0,0 +1,651 @@
+import importlib
+import itertools
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils.timezone import now
+from cars.allocation import BatchPlanner, reserve_cars
+from cars.benchmarks import reserve_concurrently
+from django.db import IntegrityError, connection
+from cars.availability import availability_cache
+from cars.car_search import get_available_cars, reserve_car, search_available_cars
+from cars.conflicts import is_overlap_conflict
+from cars.fleet import CarSchedule, fleet_timeline
+from cars.instrumentation import profiling
+from cars.models import Branch, Car, CarBranchLog, Distance, Reservation
+
+no_overlap = importlib.import_module("cars.migrations.0006_reservation_no_overlap")
+
+
+def load_fleet():
+    boston = Branch.objects.create(city="Boston")
+    new_york = Branch.objects.create(city="New York")
+    chicago = Branch.objects.create(city="Chicago")
+
+    for from_branch, to_branch, distance_km in [
+        (boston, new_york, 300),
+        (new_york, boston, 300),
+        (new_york, chicago, 800),
+        (chicago, new_york, 800),
+    ]:
+        Distance.objects.create(
+            from_branch=from_branch, to_branch=to_branch, distance_km=distance_km
+        )
+
+    start_time = now() + timedelta(days=1)
+    end_time = start_time + timedelta(hours=4)
+
+    def car(car_number, branch):
+        car = Car.objects.create(car_number=car_number, make="Toyota", model="Camry")
+        CarBranchLog.objects.create(
+            car=car, branch=branch, timestamp=now() - timedelta(days=1)
+        )
+        return car
+
+    def reserve(car, start, end, pickup_branch, return_branch):
+        Reservation.objects.create(
+            car=car,
+            start_time=start,
+            end_time=end,
+            pickup_branch=pickup_branch,
+            return_branch=return_branch,
+        )
+
+    car("C1", chicago)
+    car("C2", boston)
+    reserve(
+        car("C3", boston),
+        end_time + timedelta(minutes=30),
+        end_time + timedelta(hours=2),
+        new_york,
+        new_york,
+    )
+    reserve(
+        car("C4", chicago),
+        start_time - timedelta(hours=3),
+        start_time - timedelta(hours=2),
+        chicago,
+        new_york,
+    )
+    reserve(
+        car("C5", boston),
+        start_time + timedelta(hours=1),
+        start_time + timedelta(hours=2),
+        boston,
+        boston,
+    )
+    car("C6", new_york)
+
+    return start_time, end_time, boston, boston
+
+
+class GetAvailableCarsTestCase(TestCase):
+    def setUp(self):
+        self.search = load_fleet()
+
+    def car_numbers(self):
+        return [car.car_number for car in get_available_cars(*self.search)]
+
+    def test_python_engine(self):
+        self.assertEqual(["C2", "C1", "C6"], self.car_numbers())
+
+    @override_settings(CARS_SEARCH_ENGINE="sql")
+    def test_sql_engine(self):
+        with self.assertNumQueries(2):
+            self.assertEqual(["C2", "C6", "C1"], self.car_numbers())
+
+    @override_settings(CARS_SEARCH_ENGINE="sql")
+    @mock.patch("cars.car_search.SEARCH_BATCH_SIZE", 2)
+    def test_sql_engine_batches(self):
+        Distance.objects.matrix()
+
+        # every batch is read from the same ranked query
+        with self.assertNumQueries(1):
+            self.assertEqual(["C2", "C6", "C1"], self.car_numbers())
+
+        with self.assertNumQueries(1):
+            search = get_available_cars(*self.search)
+            cars = list(itertools.islice(search, 2))
+            search.close()
+        self.assertEqual(["C2", "C6"], [car.car_number for car in cars])
+
+    @override_settings(CARS_SEARCH_ENGINE="lazy")
+    def test_lazy_engine(self):
+        self.assertEqual(["C2", "C6", "C1"], self.car_numbers())
+
+        # the first car only needs the fleet's branches and the pickup branch
+        with self.assertNumQueries(3):
+            search = get_available_cars(*self.search)
+            self.assertEqual("C2", next(search).car_number)
+
+        with profiling() as profile:
+            self.car_numbers()
+        # every car is placed by its stored location or stay
+        self.assertEqual(0, profile.stages["unplaced"]["rows"])
+        self.assertEqual(3, profile.stages["candidates"]["calls"])
+        self.assertEqual(
+            {"next_reservation": 1, "previous_reservation": 1},
+            dict(profile.stages["feasibility"]["pruned"]),
+        )
+
+    def test_lazy_engine_places_cars_like_sql_engine(self):
+        Car.objects.create(car_number="C7", make="Toyota", model="Camry")
+        chicago = Branch.objects.get(city="Chicago")
+        # before its stored stays, C2 is placed by this log
+        CarBranchLog.objects.create(
+            car=Car.objects.get(car_number="C2"),
+            branch=chicago,
+            timestamp=now() - timedelta(days=10),
+        )
+        start_time, end_time, pickup_branch, return_branch = self.search
+
+        def branches(engine, offset):
+            search = (start_time + offset, end_time + offset)
+            with self.settings(CARS_SEARCH_ENGINE=engine):
+                return {
+                    car.car_number: car.current_branch_id
+                    for car in get_available_cars(*search, pickup_branch, return_branch)
+                }
+
+        for offset in (timedelta(days=-6), timedelta(), timedelta(hours=5)):
+            self.assertEqual(branches("sql", offset), branches("lazy", offset))
+        self.assertEqual(chicago.id, branches("lazy", timedelta(days=-6))["C2"])
+
+        with self.settings(CARS_SEARCH_ENGINE="lazy"):
+            self.assertEqual("C7", self.car_numbers()[-1])
+
+    def test_profile(self):
+        with profiling() as profile:
+            self.assertEqual(["C2", "C1", "C6"], self.car_numbers())
+
+        stages = profile.stages
+        self.assertEqual(
+            ["candidates", "next_reservations", "previous_reservations", "feasibility"],
+            list(stages),
+        )
+        self.assertEqual(5, stages["candidates"]["rows"])
+        self.assertEqual(3, stages["feasibility"]["rows"])
+        self.assertEqual(
+            {"next_reservation": 1, "previous_reservation": 1},
+            dict(stages["feasibility"]["pruned"]),
+        )
+
+        # searches outside profiling() record nothing
+        self.car_numbers()
+        self.assertEqual(1, stages["candidates"]["calls"])
+
+    def test_profile_search_command(self):
+        stdout = StringIO()
+        start_time, _, _, _ = self.search
+        call_command(
+            "profile_search",
+            "Boston",
+            "--start",
+            start_time.isoformat(),
+            "--duration",
+            "240",
+            "--planner",
+            stdout=stdout,
+        )
+        output = stdout.getvalue()
+        self.assertIn("3 of 6 cars found", output)
+        self.assertIn("next_reservation 1, previous_reservation 1", output)
+        self.assertIn("planner_assign", output)
+
+
+@override_settings(CARS_SEARCH_ENGINE="memory")
+class MemoryEngineTestCase(TestCase):
+    def setUp(self):
+        self.search = load_fleet()
+        self.addCleanup(fleet_timeline.reset)
+
+    def car_numbers(self, *search):
+        search = search or self.search
+        return [car.car_number for car in get_available_cars(*search)]
+
+    def test_falls_back_until_warm(self):
+        with self.assertNumQueries(2):
+            self.assertEqual(["C2", "C6", "C1"], self.car_numbers())
+
+    def test_matches_python_engine(self):
+        fleet_timeline.warm()
+        start_time = self.search[0]
+        branches = list(Branch.objects.all())
+        Distance.objects.matrix()
+
+        with self.assertNumQueries(0):
+            self.assertEqual(["C2", "C6", "C1"], self.car_numbers())
+
+        for offset in range(-10, 14):
+            for hours in (1, 4):
+                for pickup_branch, return_branch in itertools.product(
+                    branches, repeat=2
+                ):
+                    search = (
+                        start_time + timedelta(minutes=30 * offset),
+                        start_time + timedelta(minutes=30 * offset, hours=hours),
+                        pickup_branch,
+                        return_branch,
+                    )
+                    with override_settings(CARS_SEARCH_ENGINE="python"):
+                        expected = set(self.car_numbers(*search))
+                    self.assertEqual(expected, set(self.car_numbers(*search)), search)
+
+    def test_follows_changes(self):
+        fleet_timeline.warm()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation = reserve_car(*self.search)
+        self.assertEqual("C2", reservation.car.car_number)
+        self.assertEqual(["C6", "C1"], self.car_numbers())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            reserve_cars([self.search])
+        self.assertEqual(["C1"], self.car_numbers())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation.delete()
+            Car.objects.create(car_number="C7", make="BMW", model="X7")
+        self.assertEqual(["C2", "C1", "C7"], self.car_numbers())
+        self.assertEqual(7, fleet_timeline.stats()["cars"])
+
+    def test_changes_while_warming_are_replayed(self):
+        load = fleet_timeline._load
+
+        def load_then_reserve():
+            loaded = load()
+            with self.captureOnCommitCallbacks(execute=True):
+                reserve_car(*self.search)
+            return loaded
+
+        with mock.patch.object(fleet_timeline, "_load", load_then_reserve):
+            fleet_timeline.warm()
+
+        self.assertEqual(["C6", "C1"], self.car_numbers())
+
+    def test_updates_move_entries_between_cars(self):
+        fleet_timeline.warm()
+        reservation = Reservation.objects.get(car__car_number="C5")
+        log = CarBranchLog.objects.get(car__car_number="C6")
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation.car = Car.objects.get(car_number="C2")
+            reservation.save()
+            log.branch = Branch.objects.get(city="Chicago")
+            log.save()
+
+        with override_settings(CARS_SEARCH_ENGINE="python"):
+            expected = self.car_numbers()
+        self.assertEqual(["C5", "C1", "C6"], expected)
+        self.assertEqual(expected, self.car_numbers())
+
+    def test_first_car_only_visits_pickup_branch(self):
+        fleet_timeline.warm()
+        search = get_available_cars(*self.search)
+        with mock.patch.object(
+            CarSchedule, "branch_at", autospec=True, side_effect=CarSchedule.branch_at
+        ) as branch_at:
+            self.assertEqual("C2", next(search).car_number)
+        # C2 is the first car indexed at Boston
+        self.assertEqual(1, branch_at.call_count)
+
+    def test_logs_are_tracked_by_id(self):
+        schedule = CarSchedule().with_log(1, 10, 5).with_log(2, 10, 5)
+        self.assertEqual([1, 2], list(schedule.log_ids))
+        schedule = schedule.without_log(1)
+        self.assertEqual([2], list(schedule.log_ids))
+        self.assertEqual(5, schedule.branch_at(11))
+
+    def test_expired_copy_is_reloaded(self):
+        fleet_timeline.warm()
+        with mock.patch.object(fleet_timeline, "warm_in_background") as warm:
+            with override_settings(CARS_FLEET_TIMELINE_TTL=0):
+                with self.assertNumQueries(2):
+                    self.assertEqual(["C2", "C6", "C1"], self.car_numbers())
+        warm.assert_called()
+
+    @override_settings(CARS_RESERVATION_CHECK="constraint")
+    def test_booking_is_checked_against_database(self):
+        fleet_timeline.warm()
+        # booked by another process, so the copy does not know about it
+        Reservation.objects.bulk_create(
+            [
+                Reservation(
+                    car=Car.objects.get(car_number="C2"),
+                    start_time=self.search[1] + timedelta(minutes=30),
+                    end_time=self.search[1] + timedelta(hours=1),
+                    pickup_branch=Branch.objects.get(city="Chicago"),
+                    return_branch=Branch.objects.get(city="Chicago"),
+                )
+            ]
+        )
+
+        reservation = reserve_car(*self.search)
+        self.assertEqual("C6", reservation.car.car_number)
+
+
+@override_settings(CARS_AVAILABILITY_CACHE=True)
+class AvailabilityCacheTestCase(TestCase):
+    def setUp(self):
+        self.search = load_fleet()
+        availability_cache.clear()
+        availability_cache.reset_stats()
+
+    def car_numbers(self):
+        return [car.car_number for car in search_available_cars(*self.search)]
+
+    def reserve(self, car_number):
+        start_time, end_time, pickup_branch, return_branch = self.search
+        return Reservation.objects.create(
+            car=Car.objects.get(car_number=car_number),
+            start_time=start_time,
+            end_time=end_time,
+            pickup_branch=pickup_branch,
+            return_branch=return_branch,
+        )
+
+    def test_hit(self):
+        self.assertEqual(["C2", "C1", "C6"], self.car_numbers())
+
+        # one re-check of the cached cars, the search is not repeated
+        with self.assertNumQueries(1):
+            self.assertEqual("C2", next(search_available_cars(*self.search)).car_number)
+
+        stats = availability_cache.stats()
+        self.assertEqual(
+            (1, 1, 0.5), (stats["hits"], stats["misses"], stats["hit_ratio"])
+        )
+
+    def test_reservation_removes_car(self):
+        self.car_numbers()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.reserve("C2")
+
+        self.assertEqual(["C1", "C6"], self.car_numbers())
+        stats = availability_cache.stats()
+        self.assertEqual((1, 0), (stats["hits"], stats["stale_rejections"]))
+
+    def test_stale_hit_is_rejected(self):
+        self.car_numbers()
+        # reserved without this process' signals, e.g. by another worker
+        with mock.patch("cars.signals.availability_cache"):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.reserve("C2")
+
+        self.assertEqual(["C1", "C6"], self.car_numbers())
+        self.assertEqual(1, availability_cache.stats()["stale_rejections"])
+
+    def test_infeasible_hit_is_rejected(self):
+        self.car_numbers()
+        _, end_time, _, _ = self.search
+        # C2 could not get from Boston to New York in time for this booking
+        with mock.patch("cars.signals.availability_cache"):
+            with self.captureOnCommitCallbacks(execute=True):
+                Reservation.objects.create(
+                    car=Car.objects.get(car_number="C2"),
+                    start_time=end_time + timedelta(minutes=30),
+                    end_time=end_time + timedelta(hours=1),
+                    pickup_branch=Branch.objects.get(city="New York"),
+                    return_branch=Branch.objects.get(city="New York"),
+                )
+
+        self.assertEqual(["C1", "C6"], self.car_numbers())
+        self.assertEqual(1, availability_cache.stats()["stale_rejections"])
+
+    @mock.patch("cars.car_search.SEARCH_BATCH_SIZE", 2)
+    def test_partial_search_caches_first_batch(self):
+        search = search_available_cars(*self.search)
+        self.assertEqual("C2", next(search).car_number)
+        search.close()
+        self.assertEqual(1, availability_cache.stats()["size"])
+
+        # the cached cars first, then the exact search for the rest
+        self.assertEqual(["C2", "C1", "C6"], self.car_numbers())
+        self.assertEqual(1, availability_cache.stats()["hits"])
+
+    def test_reserve_car_fills_cache(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation = reserve_car(*self.search)
+        self.assertEqual("C2", reservation.car.car_number)
+        stats = availability_cache.stats()
+        self.assertEqual((1, 0, 1), (stats["size"], stats["hits"], stats["misses"]))
+
+        reservation = reserve_car(*self.search)
+        self.assertEqual("C1", reservation.car.car_number)
+        stats = availability_cache.stats()
+        self.assertEqual((1, 1), (stats["hits"], stats["misses"]))
+
+    def test_deleted_reservation_drops_entries(self):
+        self.car_numbers()
+        with self.captureOnCommitCallbacks(execute=True):
+            Reservation.objects.get(car__car_number="C5").delete()
+
+        self.assertEqual(["C2", "C5", "C1", "C6"], self.car_numbers())
+        self.assertEqual(0, availability_cache.stats()["hits"])
+
+    def test_deleted_reservation_frees_transfer_time(self):
+        self.car_numbers()
+        # C3's booking starts after the window, but too soon to get from Boston
+        with self.captureOnCommitCallbacks(execute=True):
+            Reservation.objects.get(car__car_number="C3").delete()
+
+        self.assertEqual(["C2", "C3", "C1", "C6"], self.car_numbers())
+        self.assertEqual(0, availability_cache.stats()["hits"])
+
+    def test_rescheduled_reservation_frees_old_window(self):
+        self.car_numbers()
+        reservation = Reservation.objects.get(car__car_number="C3")
+        reservation.start_time += timedelta(days=2)
+        reservation.end_time += timedelta(days=2)
+        with self.captureOnCommitCallbacks(execute=True):
+            reservation.save()
+
+        self.assertEqual(["C2", "C3", "C1", "C6"], self.car_numbers())
+        self.assertEqual(0, availability_cache.stats()["hits"])
+
+    def test_reserve_car_uses_cache(self):
+        self.car_numbers()
+        reservation = reserve_car(*self.search)
+        self.assertEqual("C2", reservation.car.car_number)
+        self.assertEqual(1, availability_cache.stats()["hits"])
+
+
+class ReserveCarsTestCase(TestCase):
+    def setUp(self):
+        self.boston = Branch.objects.create(city="Boston")
+        self.new_york = Branch.objects.create(city="New York")
+        Distance.objects.create(
+            from_branch=self.new_york, to_branch=self.boston, distance_km=300
+        )
+        self.start_time = now() + timedelta(days=1)
+
+        self.near_car = Car.objects.create(
+            car_number="C1", make="Toyota", model="Camry"
+        )
+        CarBranchLog.objects.create(
+            car=self.near_car, branch=self.boston, timestamp=now()
+        )
+        self.far_car = Car.objects.create(car_number="C2", make="BMW", model="X7")
+        CarBranchLog.objects.create(
+            car=self.far_car, branch=self.new_york, timestamp=now()
+        )
+        Reservation.objects.create(
+            car=self.far_car,
+            start_time=self.start_time + timedelta(hours=6),
+            end_time=self.start_time + timedelta(hours=7),
+            pickup_branch=self.boston,
+            return_branch=self.boston,
+        )
+
+    def request(self, hours):
+        return (
+            self.start_time,
+            self.start_time + timedelta(hours=hours),
+            self.boston,
+            self.boston,
+        )
+
+    def test_reassigns_car_to_serve_whole_batch(self):
+        with mock.patch.object(
+            BatchPlanner, "order", autospec=True, side_effect=BatchPlanner.order
+        ) as order:
+            reservations = reserve_cars([self.request(4), self.request(8)])
+        # the moved first request reuses the order computed for it
+        self.assertEqual(2, order.call_count)
+
+        self.assertEqual(
+            [(4, self.far_car), (8, self.near_car)],
+            [
+                ((r.end_time - r.start_time).seconds // 3600, r.car)
+                for r in reservations
+            ],
+        )
+
+    def test_fails_whole_batch(self):
+        reservations = reserve_cars([self.request(8), self.request(8)])
+
+        self.assertEqual([], reservations)
+        self.assertEqual(1, Reservation.objects.count())
+
+
+class ConcurrentReserveCarTestCase(TransactionTestCase):
+    def test_no_double_booking(self):
+        # without the overlap guard only the lock and re-check prevent it; the
+        # shared in-memory SQLite test database also makes writers retry the
+        # search, so only PostgreSQL catches a missing re-check
+        self.drop_overlap_guard()
+        self.assert_no_double_booking()
+
+    @override_settings(CARS_RESERVATION_CHECK="constraint")
+    def test_no_double_booking_with_constraint(self):
+        self.assert_no_double_booking()
+
+    def drop_overlap_guard(self):
+        def run(statements):
+            with connection.cursor() as cursor:
+                for statement in statements.get(connection.vendor, []):
+                    cursor.execute(statement)
+
+        def restore():
+            Reservation.objects.all().delete()
+            run(no_overlap.CREATE_SQL)
+
+        run(no_overlap.DROP_SQL)
+        self.addCleanup(restore)
+
+    def assert_no_double_booking(self):
+        boston = Branch.objects.create(city="Boston")
+        for number in range(3):
+            car = Car.objects.create(
+                car_number=f"C{number}", make="Toyota", model="Camry"
+            )
+            CarBranchLog.objects.create(car=car, branch=boston, timestamp=now())
+
+        start_time = now() + timedelta(days=1)
+        requests = [
+            (
+                start_time + timedelta(hours=hour),
+                start_time + timedelta(hours=hour + 2),
+                boston,
+                boston,
+            )
+            # concurrent requests overlap without sharing a window
+            for _ in range(4)
+            for hour in range(8)
+        ]
+
+        def slow_search(*args):
+            # widen the window between the search and the insert
+            cars = list(get_available_cars(*args))
+            time.sleep(0.01)
+            return iter(cars)
+
+        results = []
+
+        def recorded_reserve_car(*request):
+            reservation = reserve_car(*request)
+            results.append((request, reservation))
+            return reservation
+
+        with mock.patch("cars.car_search.get_available_cars", slow_search):
+            with mock.patch("cars.benchmarks.reserve_car", recorded_reserve_car):
+                reservations, _, errors = reserve_concurrently(requests, threads=4)
+
+        self.assertEqual([], errors)
+        self.assertEqual(len(requests), len(results))
+        for (start, end, pickup_branch, return_branch), reservation in results:
+            if reservation is not None:
+                self.assertEqual(
+                    (start, end, pickup_branch, return_branch),
+                    (
+                        reservation.start_time,
+                        reservation.end_time,
+                        reservation.pickup_branch,
+                        reservation.return_branch,
+                    ),
+                )
+        self.assertTrue(reservations)
+        self.assertEqual(len(reservations), Reservation.objects.count())
+        for reservation in Reservation.objects.all():
+            self.assertFalse(
+                Reservation.objects.filter(
+                    car=reservation.car,
+                    start_time__lte=reservation.end_time,
+                    end_time__gte=reservation.start_time,
+                )
+                .exclude(pk=reservation.pk)
+                .exists()
+            )
+
+
+@override_settings(CARS_RESERVATION_CHECK="constraint")
+class OverlapConstraintTestCase(TestCase):
+    def setUp(self):
+        self.boston = Branch.objects.create(city="Boston")
+        self.car = Car.objects.create(car_number="C1", make="Toyota", model="Camry")
+        self.start_time = now() + timedelta(days=1)
+        self.end_time = self.start_time + timedelta(hours=2)
+        Reservation.objects.create(
+            car=self.car,
+            start_time=self.start_time + timedelta(hours=1),
+            end_time=self.end_time + timedelta(hours=1),
+            pickup_branch=self.boston,
+            return_branch=self.boston,
+        )
+
+    def test_overlap_is_rejected(self):
+        with self.assertRaises(IntegrityError) as context:
+            Reservation.objects.create(
+                car=self.car,
+                start_time=self.start_time,
+                end_time=self.end_time,
+                pickup_branch=self.boston,
+                return_branch=self.boston,
+            )
+        self.assertTrue(is_overlap_conflict(context.exception))
+
+    def test_duplicate_is_rejected(self):
+        reservation = Reservation.objects.get()
+        with self.assertRaises(IntegrityError) as context:
+            Reservation.objects.create(
+                car=self.car,
+                start_time=reservation.start_time,
+                end_time=reservation.end_time,
+                pickup_branch=self.boston,
+                return_branch=self.boston,
+            )
+        self.assertTrue(is_overlap_conflict(context.exception))
+
+    def test_stale_candidate_is_skipped(self):
+        with mock.patch(
+            "cars.car_search.get_available_cars", return_value=iter([self.car])
+        ):
+            reservation = reserve_car(
+                self.start_time, self.end_time, self.boston, self.boston
+            )
+
+        self.assertIsNone(reservation)
+        self.assertEqual(1, Reservation.objects.count())
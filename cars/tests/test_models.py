@@ -1,6 +1,18 @@
 from django.test import TestCase
-from cars.models import Car, Branch, Distance, CarBranchLog, Reservation
+from cars.models import (
+    Car,
+    Branch,
+    Distance,
+    CarBranchLog,
+    CarLocation,
+    CarTransition,
+    Reservation,
+)
 from django.core.exceptions import ValidationError
+from datetime import datetime, timedelta, timezone
+from django.db import IntegrityError, transaction
+from django.utils.timezone import now
+from cars.bulk import bulk_reserve
 
 
 # Create your tests here.
@@ -39,7 +51,7 @@ class DistanceTestCase(TestCase):
         Distance.objects.create(from_branch=new_york, to_branch=boston, distance_km=300)
 
     def test_from_to_branch_is_not_equal(self):
-        boston = Branch.objects.create(city="Boston")
+        boston = Branch.objects.get(city="Boston")
         message = "{'branch': ['Can not create distance between the same branch']}"
         with self.assertRaisesMessage(ValidationError, message):
             Distance.objects.create(
@@ -50,6 +62,78 @@ class DistanceTestCase(TestCase):
         distance = Distance.objects.get(distance_km=300)
         self.assertEqual(str(distance), "New York->Boston: 300km")
 
+    def test_distance_matrix_is_cached(self):
+        new_york = Branch.objects.get(city="New York")
+        boston = Branch.objects.get(city="Boston")
+        Distance.objects.distance_km(new_york, boston)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(Distance.objects.distance_km(new_york, boston), 300)
+            self.assertEqual(
+                Distance.objects.transfer_time(new_york.id, boston.id),
+                timedelta(hours=300 / Distance.objects.CAR_SPEED),
+            )
+            self.assertIsNone(Distance.objects.distance_km(boston, new_york))
+
+    def test_distance_matrix_is_invalidated(self):
+        new_york = Branch.objects.get(city="New York")
+        boston = Branch.objects.get(city="Boston")
+        self.assertIsNone(Distance.objects.distance_km(boston, new_york))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            distance = Distance.objects.create(
+                from_branch=boston, to_branch=new_york, distance_km=310
+            )
+        self.assertEqual(Distance.objects.distance_km(boston, new_york), 310)
+
+        distance.delete()
+        self.assertIsNone(Distance.objects.distance_km(boston, new_york))
+
+    def test_distance_follows_shortest_route(self):
+        new_york = Branch.objects.get(city="New York")
+        boston = Branch.objects.get(city="Boston")
+        chicago = Branch.objects.create(city="Chicago")
+        Distance.objects.create(from_branch=boston, to_branch=chicago, distance_km=100)
+        self.assertEqual(Distance.objects.distance_km(new_york, chicago), 400)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Distance.objects.create(
+                from_branch=new_york, to_branch=chicago, distance_km=350
+            )
+        self.assertEqual(Distance.objects.distance_km(new_york, chicago), 350)
+
+        distance = Distance.objects.get(from_branch=new_york, to_branch=chicago)
+        distance.distance_km = 500
+        with self.captureOnCommitCallbacks(execute=True):
+            distance.save()
+        self.assertEqual(Distance.objects.distance_km(new_york, chicago), 400)
+
+    def test_rolled_back_distance_is_not_cached(self):
+        new_york = Branch.objects.get(city="New York")
+        boston = Branch.objects.get(city="Boston")
+        self.assertIsNone(Distance.objects.distance_km(boston, new_york))
+
+        with transaction.atomic():
+            Distance.objects.create(
+                from_branch=boston, to_branch=new_york, distance_km=310
+            )
+            transaction.set_rollback(True)
+        self.assertIsNone(Distance.objects.distance_km(boston, new_york))
+
+    def test_neighbors_are_sorted_by_distance(self):
+        new_york = Branch.objects.get(city="New York")
+        boston = Branch.objects.get(city="Boston")
+        chicago = Branch.objects.create(city="Chicago")
+        Distance.objects.create(from_branch=chicago, to_branch=boston, distance_km=100)
+
+        self.assertEqual(
+            [(0, boston.id), (100, chicago.id), (300, new_york.id)],
+            Distance.objects.matrix().neighbors(boston),
+        )
+        self.assertEqual(
+            [(0, chicago.id)], Distance.objects.matrix().neighbors(chicago)
+        )
+
 
 class ReservationTestCase(TestCase):
     def setUp(self):
@@ -68,3 +152,137 @@ class ReservationTestCase(TestCase):
         )
         car_branch_log = CarBranchLog.objects.filter(car=car)
         self.assertEqual(2, len(car_branch_log))
+
+    def test_car_location_follows_latest_transition(self):
+        car = Car.objects.get(car_number="C123456789")
+        new_york = Branch.objects.get(city="New York")
+        boston = Branch.objects.create(city="Boston")
+        Reservation.objects.create(
+            car=car,
+            start_time="2020-01-01T00:00:00Z",
+            end_time="2020-01-02T00:00:00Z",
+            pickup_branch=new_york,
+            return_branch=boston,
+        )
+        CarBranchLog.objects.create(
+            car=car, branch=new_york, timestamp="2019-12-01T00:00:00Z"
+        )
+
+        location = CarLocation.objects.get(car=car)
+        self.assertEqual(location.branch, boston)
+
+        car = Car.objects.with_current_branch("2020-01-01T12:00:00Z").get(pk=car.pk)
+        self.assertEqual(car.current_branch_id, new_york.id)
+        car = Car.objects.with_current_branch("2020-01-03T00:00:00Z").get(pk=car.pk)
+        self.assertEqual(car.current_branch_id, boston.id)
+
+        CarBranchLog.objects.get(branch=boston).delete()
+        self.assertEqual(CarLocation.objects.get(car=car).branch, new_york)
+
+    def test_car_transitions_hold_current_and_upcoming_stays(self):
+        car = Car.objects.get(car_number="C123456789")
+        new_york = Branch.objects.get(city="New York")
+        boston = Branch.objects.create(city="Boston")
+        start_time = now() + timedelta(days=1)
+        end_time = start_time + timedelta(hours=4)
+        CarBranchLog.objects.create(
+            car=car, branch=boston, timestamp=now() - timedelta(days=2)
+        )
+        CarBranchLog.objects.create(
+            car=car, branch=new_york, timestamp=now() - timedelta(days=1)
+        )
+        Reservation.objects.create(
+            car=car,
+            start_time=start_time,
+            end_time=end_time,
+            pickup_branch=new_york,
+            return_branch=boston,
+        )
+
+        # the stay current now and the upcoming ones, but not older stays
+        stays = CarTransition.objects.filter(car=car).order_by("timestamp")
+        self.assertEqual(
+            [
+                (new_york.id, start_time),
+                (new_york.id, end_time),
+                (boston.id, None),
+            ],
+            [(stay.branch_id, stay.until) for stay in stays],
+        )
+
+        CarBranchLog.objects.get(branch=new_york, timestamp=start_time).delete()
+        self.assertEqual(
+            [(new_york.id, end_time), (boston.id, None)],
+            [
+                (stay.branch_id, stay.until)
+                for stay in CarTransition.objects.filter(car=car).order_by("timestamp")
+            ],
+        )
+
+        # with the past log rewritten behind its back, the stays still answer
+        CarBranchLog.objects.filter(car=car, timestamp__lt=now()).update(branch=boston)
+        for current_time, branch in [
+            (now(), new_york),
+            (start_time + timedelta(hours=1), new_york),
+            (end_time + timedelta(hours=1), boston),
+        ]:
+            car = Car.objects.with_current_branch(current_time).get(pk=car.pk)
+            self.assertEqual(branch.id, car.current_branch_id)
+
+    def test_bulk_reserve(self):
+        car = Car.objects.get(car_number="C123456789")
+        new_york = Branch.objects.get(city="New York")
+        boston = Branch.objects.create(city="Boston")
+        reservations = [
+            Reservation(
+                car=car,
+                start_time=datetime(2020, 1, day, tzinfo=timezone.utc),
+                end_time=datetime(2020, 1, day, 12, tzinfo=timezone.utc),
+                pickup_branch=new_york,
+                return_branch=boston,
+            )
+            for day in (1, 2)
+        ]
+
+        # savepoint, three inserts, location lookup, three to rebuild the
+        # transitions, release
+        with self.assertNumQueries(9):
+            reservations = bulk_reserve(reservations)
+
+        self.assertTrue(all(reservation.pk for reservation in reservations))
+        self.assertEqual(4, CarBranchLog.objects.filter(car=car).count())
+        location = CarLocation.objects.get(car=car)
+        self.assertEqual(boston.id, location.branch_id)
+        self.assertEqual(reservations[1].end_time, location.timestamp)
+
+        with self.assertRaises(IntegrityError):
+            bulk_reserve([reservations[0]])
+
+    def test_next_and_previous_reservations(self):
+        car = Car.objects.get(car_number="C123456789")
+        other_car = Car.objects.create(car_number="C987654321", make="BMW", model="X7")
+        branch = Branch.objects.get(city="New York")
+        for reserved_car in (car, other_car):
+            for day in (1, 3, 5):
+                Reservation.objects.create(
+                    car=reserved_car,
+                    start_time=datetime(2020, 1, day, tzinfo=timezone.utc),
+                    end_time=datetime(2020, 1, day, 12, tzinfo=timezone.utc),
+                    pickup_branch=branch,
+                    return_branch=branch,
+                )
+
+        date_time = datetime(2020, 1, 3, 6, tzinfo=timezone.utc)
+        next_reservations = Reservation.objects.next_reservations(date_time)
+        self.assertEqual(
+            {(car.id, 5), (other_car.id, 5)},
+            {(r.car_id, r.start_time.day) for r in next_reservations},
+        )
+        previous_reservations = Reservation.objects.previous_reservations(date_time)
+        self.assertEqual(
+            {(car.id, 1), (other_car.id, 1)},
+            {(r.car_id, r.end_time.day) for r in previous_reservations},
+        )
+        self.assertEqual(
+            5, next_reservations.filter(car=car).first().start_time.day
+        )
@@ -1,11 +1,20 @@
 import json
+from unittest import mock
+
+from asgiref.sync import sync_to_async
 
 from graphene_django.utils.testing import GraphQLTestCase
 from django.utils.timezone import now
 from datetime import timedelta
 from cars.models import Car, Branch, Distance, CarBranchLog, Reservation
 from django.test import TestCase
-from graphql import GraphQLError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from cars.documents import document_cache, query_hash
+from cars.metrics import operation_metrics
+from cars.responses import cache_policy, get_cache
+from cars.views import AsyncGraphQLView
+from graphql import GraphQLError, NoSchemaIntrospectionCustomRule, parse
 from django.core.exceptions import ValidationError
 
 
@@ -76,7 +85,7 @@ class QueryTestCase(GraphQLTestCase):
             "data": {
                 "allCars": [
                     {
-                        "id": "1",
+                        "id": str(self.upcoming_reservation.car.id),
                         "carNumber": "C123456789",
                         "make": "Toyota",
                         "model": "Camry",
@@ -147,6 +156,450 @@ class QueryTestCase(GraphQLTestCase):
             expected_content["data"]["upcomingReservations"][0],
         )
 
+    def test_query_upcoming_reservations_num_queries(self):
+        branches = list(Branch.objects.all())
+        for number in range(5):
+            car = Car.objects.create(
+                car_number=f"C{number}", make="Toyota", model="Camry"
+            )
+            Reservation.objects.create(
+                car=car,
+                pickup_branch=branches[number % 3],
+                return_branch=branches[(number + 1) % 3],
+                start_time=now() + timedelta(days=3),
+                end_time=now() + timedelta(days=4),
+            )
+
+        with self.assertNumQueries(1):
+            response = self.query(
+                """
+                query {
+                    upcomingReservations {
+                        id
+                        car {
+                            carNumber
+                        }
+                        pickupBranch {
+                            city
+                        }
+                        returnBranch {
+                            city
+                        }
+                    }
+                }
+                """
+            )
+
+        self.assertResponseNoErrors(response)
+        content = json.loads(response.content)
+        self.assertEqual(6, len(content["data"]["upcomingReservations"]))
+
+    def test_unjoined_relations_are_batched(self):
+        branches = list(Branch.objects.all())
+        for number in range(5):
+            car = Car.objects.create(
+                car_number=f"C{number}", make="Toyota", model="Camry"
+            )
+            Reservation.objects.create(
+                car=car,
+                pickup_branch=branches[number % 3],
+                return_branch=branches[(number + 1) % 3],
+                start_time=now() + timedelta(days=3),
+                end_time=now() + timedelta(days=4),
+            )
+
+        # the list, then one query for the cars and one for both branches
+        with mock.patch(
+            "cars.schema.plan_queryset", lambda queryset, selection: queryset
+        ), self.assertNumQueries(3):
+            response = self.query(
+                """
+                query {
+                    upcomingReservations {
+                        car {
+                            carNumber
+                        }
+                        pickupBranch {
+                            city
+                        }
+                        returnBranch {
+                            city
+                        }
+                    }
+                }
+                """
+            )
+
+        self.assertResponseNoErrors(response)
+        content = json.loads(response.content)
+        self.assertEqual(
+            ["C123456789", "C0", "C1", "C2", "C3", "C4"],
+            [
+                reservation["car"]["carNumber"]
+                for reservation in content["data"]["upcomingReservations"]
+            ],
+        )
+
+    def test_query_upcoming_reservations_fetches_requested_columns(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.query(
+                """
+                query {
+                    upcomingReservations {
+                        startTime
+                        ...returnCity
+                    }
+                }
+                fragment returnCity on ReservationType {
+                    returnBranch {
+                        city
+                    }
+                }
+                """
+            )
+
+        self.assertResponseNoErrors(response)
+        self.assertEqual(1, len(queries))
+        sql = queries[0]["sql"]
+        self.assertIn('"cars_branch"."city"', sql)
+        self.assertNotIn("cars_car", sql)
+        self.assertNotIn('"cars_reservation"."end_time"', sql)
+
+    def test_query_upcoming_reservations_connection(self):
+        for number in range(3):
+            Reservation.objects.create(
+                car=self.upcoming_reservation.car,
+                pickup_branch=self.upcoming_reservation.return_branch,
+                return_branch=self.upcoming_reservation.return_branch,
+                start_time=now() + timedelta(days=3 + number),
+                end_time=now() + timedelta(days=3 + number, hours=1),
+            )
+
+        query = """
+            query($after: String) {
+                upcomingReservationsConnection(first: 3, after: $after) {
+                    edges {
+                        node {
+                            id
+                        }
+                    }
+                    pageInfo {
+                        hasNextPage
+                        endCursor
+                    }
+                }
+            }
+            """
+        pages = []
+        after = None
+        while True:
+            response = self.query(query, variables={"after": after})
+            self.assertResponseNoErrors(response)
+            connection = json.loads(response.content)["data"][
+                "upcomingReservationsConnection"
+            ]
+            pages.append([edge["node"]["id"] for edge in connection["edges"]])
+            if not connection["pageInfo"]["hasNextPage"]:
+                break
+            after = connection["pageInfo"]["endCursor"]
+
+        expected = [
+            str(r.id) for r in Reservation.objects.upcoming().order_by("start_time")
+        ]
+        self.assertEqual([expected[:3], expected[3:]], pages)
+
+    def test_query_all_cars_connection_invalid_cursor(self):
+        response = self.query(
+            """
+            query {
+                allCarsConnection(after: "invalid") {
+                    edges {
+                        cursor
+                    }
+                }
+            }
+            """
+        )
+        self.assertResponseHasErrors(response)
+
+
+class AvailableCarsTestCase(GraphQLTestCase):
+    def setUp(self):
+        load_sample_data()
+        Car.objects.create(car_number="C987654321", make="BMW", model="X7")
+
+    def available_cars(self, first):
+        start_time = (now() + timedelta(days=3)).strftime("%Y-%m-%dT%H:%M:%S+00:00")
+        response = self.query(
+            """
+            query ($startTime: DateTime!, $first: Int) {
+                availableCars(
+                    startTime: $startTime
+                    durationMinutes: 300
+                    pickupBranch: {city: "Boston"}
+                    returnBranch: {city: "New York"}
+                    first: $first
+                ) {
+                    carNumber
+                }
+            }
+            """,
+            variables={"startTime": start_time, "first": first},
+        )
+        self.assertResponseNoErrors(response)
+        return json.loads(response.content)["data"]["availableCars"]
+
+    def test_available_cars(self):
+        reservations = Reservation.objects.count()
+
+        self.assertEqual(
+            [{"carNumber": "C123456789"}, {"carNumber": "C987654321"}],
+            self.available_cars(None),
+        )
+        self.assertEqual([{"carNumber": "C123456789"}], self.available_cars(1))
+        self.assertEqual([], self.available_cars(0))
+        self.assertEqual(reservations, Reservation.objects.count())
+
+
+class AsyncViewTestCase(TestCase):
+    async def test_query_from_event_loop(self):
+        _, reservation = await sync_to_async(load_sample_data)()
+
+        response = await self.async_client.post(
+            "/graphql",
+            {
+                "query": """
+                query {
+                    allCars { carNumber }
+                    upcomingReservations {
+                        id
+                        car { carNumber }
+                        returnBranch { city }
+                    }
+                }
+                """
+            },
+            content_type="application/json",
+        )
+
+        content = json.loads(response.content)
+        self.assertNotIn("errors", content)
+        self.assertEqual(
+            {
+                "allCars": [{"carNumber": "C123456789"}],
+                "upcomingReservations": [
+                    {
+                        "id": str(reservation.id),
+                        "car": {"carNumber": "C123456789"},
+                        "returnBranch": {"city": "New York"},
+                    }
+                ],
+            },
+            content["data"],
+        )
+
+
+class PersistedQueryTestCase(TestCase):
+    query = "query { allCars { carNumber } }"
+
+    def setUp(self):
+        load_sample_data()
+        document_cache.clear()
+
+    def post(self, **data):
+        response = self.client.post("/graphql", data, content_type="application/json")
+        return json.loads(response.content)
+
+    def persisted_query(self, sha256_hash):
+        return {"persistedQuery": {"version": 1, "sha256Hash": sha256_hash}}
+
+    def test_query_by_hash(self):
+        sha256_hash = query_hash(self.query)
+
+        content = self.post(extensions=self.persisted_query(sha256_hash))
+        self.assertEqual(
+            "PERSISTED_QUERY_NOT_FOUND", content["errors"][0]["extensions"]["code"]
+        )
+
+        content = self.post(
+            query=self.query, extensions=self.persisted_query(sha256_hash)
+        )
+        self.assertEqual([{"carNumber": "C123456789"}], content["data"]["allCars"])
+
+        content = self.post(extensions=self.persisted_query(sha256_hash))
+        self.assertEqual([{"carNumber": "C123456789"}], content["data"]["allCars"])
+        self.assertEqual(1, document_cache.stats()["hits"])
+
+    def test_hash_mismatch(self):
+        content = self.post(
+            query=self.query, extensions=self.persisted_query(query_hash("{ car }"))
+        )
+        self.assertEqual(
+            "provided sha does not match query", content["errors"][0]["message"]
+        )
+
+    def test_invalid_persisted_query(self):
+        for extensions in (
+            "[]",
+            [1],
+            {"persistedQuery": "abc"},
+            {"persistedQuery": [1]},
+            {"persistedQuery": {"version": 1, "sha256Hash": 1}},
+        ):
+            response = self.client.post(
+                "/graphql",
+                {"query": self.query, "extensions": extensions},
+                content_type="application/json",
+            )
+            self.assertEqual(400, response.status_code)
+            message = json.loads(response.content)["errors"][0]["message"]
+            self.assertIn("must be", message)
+
+        # the same 400 as invalid JSON, also when sent as a query parameter
+        for extensions in ("{", "[]"):
+            response = self.client.get(
+                "/graphql", {"query": self.query, "extensions": extensions}
+            )
+            self.assertEqual(400, response.status_code)
+
+    def test_validation_rules(self):
+        introspection = "query { __schema { queryType { name } } }"
+        with mock.patch.object(
+            AsyncGraphQLView, "validation_rules", (NoSchemaIntrospectionCustomRule,)
+        ):
+            content = self.post(query=introspection)
+        self.assertIn("introspection", content["errors"][0]["message"])
+
+        content = self.post(query=introspection)
+        self.assertEqual("Query", content["data"]["__schema"]["queryType"]["name"])
+
+    def test_cached_documents(self):
+        other_query = "query { upcomingReservations { id } }"
+        with override_settings(CARS_DOCUMENT_CACHE_SIZE=1):
+            self.post(query=self.query)
+            self.post(query=self.query)
+            self.post(query=other_query)
+            content = self.post(query=self.query)
+
+        self.assertEqual([{"carNumber": "C123456789"}], content["data"]["allCars"])
+        stats = document_cache.stats()
+        self.assertEqual((1, 1, 3), (stats["size"], stats["hits"], stats["misses"]))
+
+    def test_validation_errors_are_cached(self):
+        for _ in range(2):
+            content = self.post(query="query { allCars { color } }")
+            self.assertIn("color", content["errors"][0]["message"])
+        self.assertEqual(1, document_cache.stats()["hits"])
+
+
+@override_settings(CARS_RESPONSE_CACHE=True)
+class ResponseCacheTestCase(TestCase):
+    cars_query = "query { allCars { carNumber } }"
+    reservations_query = "query { upcomingReservations { id } }"
+
+    def setUp(self):
+        load_sample_data()
+        get_cache().clear()
+
+    def post(self, query):
+        response = self.client.post(
+            "/graphql", {"query": query}, content_type="application/json"
+        )
+        return json.loads(response.content)["data"]
+
+    def test_repeated_query_skips_database(self):
+        self.post(self.cars_query)
+        with self.assertNumQueries(0):
+            data = self.post("query {\n  allCars { carNumber }\n}")
+        self.assertEqual([{"carNumber": "C123456789"}], data["allCars"])
+
+    def test_change_invalidates_dependent_fields(self):
+        self.post(self.cars_query)
+        self.post(self.reservations_query)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Branch.objects.create(city="Denver")
+
+        with self.assertNumQueries(0):
+            self.post(self.cars_query)
+        with self.assertNumQueries(1):
+            self.post(self.reservations_query)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Car.objects.create(car_number="C987654321", make="BMW", model="X7")
+
+        data = self.post(self.cars_query)
+        self.assertEqual(2, len(data["allCars"]))
+
+    def test_policy(self):
+        self.assertIsNone(cache_policy(parse("mutation { deleteCar }"), None))
+        self.assertIsNone(
+            cache_policy(parse("{ ... on Query { allCars { id } } }"), None)
+        )
+        self.assertEqual(300, cache_policy(parse(self.cars_query), None)[1])
+        self.assertEqual(30, cache_policy(parse(self.reservations_query), None)[1])
+
+
+@override_settings(CARS_METRICS=True)
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        load_sample_data()
+        operation_metrics.clear()
+
+    def post(self, query):
+        response = self.client.post(
+            "/graphql", {"query": query}, content_type="application/json"
+        )
+        return json.loads(response.content)
+
+    def test_operations_are_recorded(self):
+        start_time = (now() + timedelta(days=5)).isoformat()
+        self.post("query CarList { allCars { carNumber } }")
+        content = self.post(
+            """
+            mutation {
+                createReservations(reservationsData: [
+                    {pickupBranch: {city: "Boston"}, returnBranch: {city: "New York"},
+                     startTime: "%s", durationMinutes: 400}
+                ]) { reservations { id } }
+            }
+            """
+            % start_time
+        )
+        self.assertNotIn("errors", content)
+
+        metrics = self.client.get("/metrics").content.decode()
+        self.assertIn(
+            'cars_graphql_operation_seconds_count{operation="CarList"} 1', metrics
+        )
+        self.assertIn('cars_graphql_sql_queries_total{operation="CarList"} 1', metrics)
+        self.assertIn(
+            'cars_graphql_slowest_resolver_seconds{operation="CarList",'
+            'resolver="Query.allCars"}',
+            metrics,
+        )
+        for section in ("search", "assign", "insert"):
+            self.assertIn(
+                'cars_graphql_section_seconds_total{operation="createReservations",'
+                f'section="{section}"}}',
+                metrics,
+            )
+
+    def test_log_line(self):
+        with override_settings(CARS_METRICS_LOG=True):
+            with self.assertLogs("cars.metrics") as logs:
+                self.post("query { allCars { carNumber } }")
+
+        line = json.loads(logs.records[0].getMessage())
+        self.assertEqual("allCars", line["operation"])
+        self.assertEqual(1, line["queries"])
+
+    def test_disabled(self):
+        with override_settings(CARS_METRICS=False):
+            self.post("query { allCars { carNumber } }")
+            self.assertEqual(404, self.client.get("/metrics").status_code)
+        self.assertNotIn("allCars", operation_metrics.render())
+
 
 class MutationTestCase(GraphQLTestCase):
     def setUp(self):
@@ -288,15 +741,21 @@ class MutationTestCase(GraphQLTestCase):
             "data": {
                 "createReservation": {
                     "reservation": {
-                        "id": "3",
+                        "id": str(Reservation.objects.latest("id").id),
                         "car": {
-                            "id": "1",
+                            "id": str(self.upcoming_reservation.car.id),
                             "carNumber": "C123456789",
                             "make": "Toyota",
                             "model": "Camry",
                         },
-                        "pickupBranch": {"id": "1", "city": "Boston"},
-                        "returnBranch": {"id": "2", "city": "New York"},
+                        "pickupBranch": {
+                            "id": str(Branch.objects.get(city="Boston").id),
+                            "city": "Boston",
+                        },
+                        "returnBranch": {
+                            "id": str(Branch.objects.get(city="New York").id),
+                            "city": "New York",
+                        },
                         "startTime": start_time,
                         "endTime": end_time,
                     }
@@ -1,5 +1,38 @@
+import asyncio
+import functools
+import inspect
 import math
 
+from asgiref.sync import sync_to_async
+from django.db.models import QuerySet
+
 
 def total_minutes(transfer_time):
     return math.ceil(transfer_time.total_seconds() / 60)
+
+
+def maybe_async(resolver):
+    """Run a resolver that uses the ORM in a thread when executed asynchronously.
+
+    Under ``AsyncGraphQLView`` resolvers are called from the event loop, where
+    the ORM refuses to run, so the resolver returns an awaitable of its
+    result computed by ``sync_to_async``. Querysets and generators are
+    evaluated in that thread as well. Called without a running event loop the
+    resolver runs as is.
+    """
+
+    def evaluate(*args, **kwargs):
+        result = resolver(*args, **kwargs)
+        if isinstance(result, QuerySet) or inspect.isgenerator(result):
+            return list(result)
+        return result
+
+    @functools.wraps(resolver)
+    def wrapper(*args, **kwargs):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return resolver(*args, **kwargs)
+        return sync_to_async(evaluate)(*args, **kwargs)
+
+    return wrapper
@@ -1,3 +1,204 @@
-from django.shortcuts import render
+import inspect
+import json
 
-# Create your views here.
+from django.conf import settings
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseNotAllowed,
+)
+from graphene_django.views import GraphQLView, HttpError
+from graphql import (
+    ExecutionResult,
+    GraphQLError,
+    OperationType,
+    execute,
+    get_operation_ast,
+)
+from cars.documents import document_cache
+from cars.instrumentation import ResolverTimingMiddleware, current_operation
+from cars.metrics import operation_metrics
+from cars.responses import cache_key, cache_policy, get_cache
+
+
+class AsyncGraphQLView(GraphQLView):
+    """GraphQLView executing the schema asynchronously.
+
+    Resolvers decorated with ``cars.utils.maybe_async`` run their ORM work in
+    a thread while the request waits on the event loop, so under an ASGI
+    server a slow query does not hold a worker for the whole request.
+    Django does not support ``ATOMIC_REQUESTS`` for async views and
+    ``ATOMIC_MUTATIONS`` is not supported either; mutations manage their own
+    transactions.
+
+    Documents are parsed and validated once and then served from
+    ``document_cache``, which also answers automatic persisted queries: a
+    request may send ``extensions.persistedQuery.sha256Hash`` instead of the
+    query text once the query has been sent with its hash.
+
+    With ``CARS_RESPONSE_CACHE`` the data of queries made only of the read
+    fields in ``cars.responses.CACHED_FIELDS`` is cached as well.
+
+    Requests recorded by ``operation_metrics_middleware`` also run
+    ``ResolverTimingMiddleware``.
+
+    Only the execution step differs from ``GraphQLView``: ``dispatch`` first
+    executes the operations of the request on the event loop and then hands
+    over to ``GraphQLView.dispatch``, whose ``execute_graphql_request``
+    returns those results in order.
+    """
+
+    view_is_async = True
+    # extra validation rules run after graphql-core's specified_rules, as in
+    # AsyncGraphQLView.as_view(validation_rules=[DisableIntrospection])
+    validation_rules = ()
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.results = await self.execute_operations(request)
+        return super().dispatch(request, *args, **kwargs)
+
+    async def execute_operations(self, request):
+        """Execute the operations ``GraphQLView.dispatch`` will ask for.
+
+        Stops at the first request error; ``dispatch`` reads the request
+        again and reports it.
+        """
+        results = []
+        if request.method.lower() not in ("get", "post"):
+            return results
+
+        try:
+            data = self.parse_body(request)
+            if self.graphiql and self.can_display_graphiql(request, data):
+                return results
+
+            for entry in data if self.batch else [data]:
+                query, variables, operation_name, _ = self.get_graphql_params(
+                    request, entry
+                )
+                results.append(
+                    await self.execute_graphql_request_async(
+                        request, entry, query, variables, operation_name
+                    )
+                )
+        except HttpError as error:
+            results.append(error)
+        return results
+
+    def execute_graphql_request(self, request, *args, **kwargs):
+        result = self.results.pop(0)
+        if isinstance(result, HttpError):
+            raise result
+        return result
+
+    @staticmethod
+    def get_persisted_query_hash(request, data):
+        extensions = request.GET.get("extensions") or data.get("extensions")
+        if not extensions:
+            return None
+
+        if isinstance(extensions, str):
+            try:
+                extensions = json.loads(extensions)
+            except ValueError:
+                raise HttpError(HttpResponseBadRequest("Extensions are invalid JSON."))
+
+        if not isinstance(extensions, dict):
+            raise HttpError(HttpResponseBadRequest("Extensions must be an object."))
+        persisted_query = extensions.get("persistedQuery")
+        if not persisted_query:
+            return None
+        if not isinstance(persisted_query, dict):
+            raise HttpError(HttpResponseBadRequest("persistedQuery must be an object."))
+        if persisted_query.get("version") != 1:
+            raise HttpError(
+                HttpResponseBadRequest("Unsupported persisted query version.")
+            )
+        sha256_hash = persisted_query.get("sha256Hash")
+        if sha256_hash is not None and not isinstance(sha256_hash, str):
+            raise HttpError(HttpResponseBadRequest("sha256Hash must be a string."))
+        return sha256_hash
+
+    async def execute_graphql_request_async(
+        self, request, data, query, variables, operation_name
+    ):
+        sha256_hash = self.get_persisted_query_hash(request, data)
+        if not query and not sha256_hash:
+            raise HttpError(HttpResponseBadRequest("Must provide query string."))
+
+        try:
+            document, errors = document_cache.get(
+                self.schema.graphql_schema, query, sha256_hash, self.validation_rules
+            )
+        except GraphQLError as e:
+            return ExecutionResult(errors=[e])
+        if errors:
+            return ExecutionResult(errors=errors)
+
+        if request.method.lower() == "get":
+            operation_ast = get_operation_ast(document, operation_name)
+            if operation_ast and operation_ast.operation != OperationType.QUERY:
+                raise HttpError(
+                    HttpResponseNotAllowed(
+                        ["POST"],
+                        "Can only perform a {} operation from a POST request.".format(
+                            operation_ast.operation.value
+                        ),
+                    )
+                )
+
+        policy = None
+        if settings.CARS_RESPONSE_CACHE:
+            policy = cache_policy(document, operation_name)
+        if policy is None:
+            return await self.execute_document(
+                request, document, variables, operation_name
+            )
+
+        labels, timeout = policy
+        key = await cache_key(labels, document, operation_name, variables)
+        data = await get_cache().aget(key)
+        if data is not None:
+            return ExecutionResult(data=data)
+
+        result = await self.execute_document(
+            request, document, variables, operation_name
+        )
+        if not result.errors:
+            await get_cache().aset(key, result.data, timeout)
+        return result
+
+    def get_middleware(self, request):
+        middleware = super().get_middleware(request)
+        if current_operation.get() is not None:
+            middleware = [*(middleware or []), ResolverTimingMiddleware()]
+        return middleware
+
+    async def execute_document(self, request, document, variables, operation_name):
+        try:
+            result = execute(
+                self.schema.graphql_schema,
+                document,
+                root_value=self.get_root_value(request),
+                context_value=self.get_context(request),
+                variable_values=variables,
+                operation_name=operation_name,
+                middleware=self.get_middleware(request),
+                execution_context_class=self.execution_context_class,
+            )
+            if inspect.isawaitable(result):
+                result = await result
+            return result
+        except Exception as e:
+            return ExecutionResult(errors=[e])
+
+
+def metrics(request):
+    """Serve ``operation_metrics`` in Prometheus text format."""
+    if not settings.CARS_METRICS:
+        raise Http404("Metrics are disabled.")
+    return HttpResponse(
+        operation_metrics.render(),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )